@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Resumable batch runner that routes each item to the cheapest backend.
+
+Items are read from a JSONL or CSV file, and each one is either a paper (with any
+of the fields doi, pmid, ut and title) or an author pair (with author1 and author2).
+Papers with IDs are resolved with the LAMR API first, which is by far the fastest,
+and only papers that are not found there are searched for by scraping WoK, like titles
+and author pairs. For example:
+
+    python wok_batch.py papers.jsonl results.jsonl --cache wok_cache.sqlite
+
+Each result is appended to the output as one line of JSON with the key of the item,
+the backend that answered it and the result, and the key is then added to a journal.
+A run that is interrupted can be started again with the same arguments, and it will
+skip all items in the journal, so nothing is queried twice.
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+
+from wok_cache import IDCache, QueryCache
+from wok_lamr import WebOfScienceAPI
+from wok_search import WebOfKnowledgeSearcher
+
+
+# The fields of items that are used as strings, which may be numbers in JSON (like PMIDs).
+text_fields = ('doi', 'pmid', 'ut', 'title', 'author1', 'author2')
+
+
+def read_items(path):
+    """Generate (key, item) tuples from a JSONL or CSV file (by its extension).
+
+    The key of each item is its id field, or else its line number (counted from one,
+    without the CSV header), so the input should not change between runs that resume.
+    Empty values are dropped, so that missing IDs are simply not there (as are the missing
+    values in CSV rows with fewer fields than the header), and text fields become strings.
+    """
+
+    with open(path, 'rb') as f:
+        if path.lower().endswith('.csv'):
+            rows = (dict((k, v.decode('utf-8')) for k, v in row.items() if k and v is not None) for row in csv.DictReader(f))
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for i, row in enumerate(rows, 1):
+            item = dict((k, v) for k, v in row.items() if v not in (None, ''))
+            for k in text_fields:
+                if k in item and not isinstance(item[k], basestring):
+                    item[k] = unicode(item[k])
+            yield unicode(item.get('id', i)), item
+
+
+class BatchRunner:
+    """Query for items in chunks, appending results to an output file and keys to a journal.
+
+    The searcher is only created when some item needs it, since that already costs a session.
+    Items that fail in the searcher are not journaled, so they are tried again when resuming,
+    and neither are items that are not found after their LAMR request failed, or items
+    that are not queried at all (without searches).
+    """
+
+    # The number of items that are read and routed together.
+    chunk_size = 500
+
+    # The IDs that papers are resolved by with LAMR, in order of priority.
+    id_order = ('doi', 'pmid', 'ut')
+
+    def __init__(self, output, journal=None, cache=None, search=True, logfunc=None):
+
+        self.log = logfunc or (lambda msg: sys.stdout.write("%s\n" % msg))
+
+        # The optional cache file is shared by LAMR and searcher results (see wok_cache.py).
+        self.id_cache = cache and IDCache(cache)
+        self.query_cache = cache and QueryCache(cache)
+
+        self.search = search
+        self.searcher = None
+
+        self.journal_path = journal or output + '.journal'
+        self.done = set()
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as f:
+                self.done = set(line.rstrip('\n').decode('utf-8') for line in f if line.strip())
+            self.log("Resuming, with %i items already done." % len(self.done))
+
+        # Both files are only ever appended to, and the journal is written after the output,
+        # so an item is only skipped once its result has been written (but if the run stops
+        # in between, the result of that item will appear twice in the output).
+        self.output = open(output, 'ab')
+        self.journal = open(self.journal_path, 'ab')
+
+        self.counts = {'lamr' : 0, 'search' : 0, 'none' : 0, 'failed' : 0, 'unqueried' : 0, 'skipped' : 0}
+
+        # The keys of items in the current chunk whose LAMR request failed.
+        self.lamr_failed = set()
+
+    def close(self):
+        self.output.close()
+        self.journal.close()
+        if self.id_cache:
+            self.id_cache.close()
+            self.query_cache.close()
+
+    def write(self, key, source, result):
+        """Append the result for an item to the output, and then mark it as done in the journal."""
+        self.output.write(json.dumps({'key' : key, 'source' : source, 'result' : result}) + '\n')
+        self.output.flush()
+        self.journal.write(key.encode('utf-8') + '\n')
+        self.journal.flush()
+        self.done.add(key)
+        self.counts[source] += 1
+
+    def write_none(self, key, result):
+        """Write that an item was not found, unless its LAMR request failed, so that it might be."""
+        if key in self.lamr_failed:
+            self.counts['failed'] += 1
+        else:
+            self.write(key, 'none', result)
+
+    def get_searcher(self):
+        if not self.searcher:
+            self.searcher = WebOfKnowledgeSearcher(cache=self.query_cache, logfunc=self.log)
+        return self.searcher
+
+    def run(self, items):
+        """Process all (key, item) tuples that are not done yet, in chunks."""
+
+        chunk = []
+        for key, item in items:
+            if key in self.done:
+                self.counts['skipped'] += 1
+                continue
+            chunk.append((key, item))
+            if len(chunk) == self.chunk_size:
+                self.run_chunk(chunk)
+                chunk = []
+        if chunk:
+            self.run_chunk(chunk)
+
+        self.log("Done: %(lamr)i items from LAMR, %(search)i from searches, %(none)i not found, "
+                 "%(failed)i failed, %(unqueried)i not queried and %(skipped)i skipped from an earlier run." % self.counts)
+        return self.counts
+
+    def run_chunk(self, chunk):
+        """Route the items in a chunk: papers with IDs to LAMR first, and everything else to the searcher."""
+
+        pairs = [(key, item) for key, item in chunk if 'author1' in item and 'author2' in item]
+        papers = [(key, item) for key, item in chunk if not ('author1' in item and 'author2' in item)]
+
+        with_ids = [(key, item) for key, item in papers if any(item.get(t) for t in self.id_order)]
+        misses = [(key, item) for key, item in papers if not any(item.get(t) for t in self.id_order)]
+        self.lamr_failed = set()
+        if with_ids:
+            api = WebOfScienceAPI([item for key, item in with_ids], cache=self.id_cache)
+            resolved = api.resolve(order=self.id_order)
+            self.lamr_failed = set(with_ids[i][0] for i in api.failed)
+            for (key, item), paper in zip(with_ids, resolved):
+                if paper:
+                    self.write(key, 'lamr', paper)
+                else:
+                    misses.append((key, item))
+
+        # Without searches, only items that LAMR did not find are done, and all others
+        # (without IDs, or author pairs) are left for a run with searches.
+        if not self.search:
+            for key, item in misses:
+                if any(item.get(t) for t in self.id_order):
+                    self.write_none(key, None)
+                else:
+                    self.counts['unqueried'] += 1
+            self.counts['unqueried'] += len(pairs)
+            return
+
+        self.search_titles([(key, item) for key, item in misses if item.get('title')])
+        self.search_dois([(key, item) for key, item in misses if not item.get('title') and item.get('doi')])
+        for key, item in misses:
+            if not item.get('title') and not item.get('doi'):
+                self.write_none(key, None)
+        self.search_pairs(pairs)
+
+    @staticmethod
+    def normalize_title(title):
+        return ' '.join(re.sub(r'\W+', ' ', title.lower(), flags=re.U).split())
+
+    def search_titles(self, papers):
+        """Search for papers by title in batches, and assign the results back to papers by title."""
+
+        if not papers:
+            return
+        searcher = self.get_searcher()
+        batch_size = searcher.max_batch_size
+        for i in range(0, len(papers), batch_size):
+            batch = papers[i:i+batch_size]
+            articles, npages = searcher.query_for_title([item for key, item in batch])
+            if articles == -1:
+                self.counts['failed'] += len(batch)
+                continue
+            found = {}
+            for article in articles:
+                found.setdefault(self.normalize_title(article.get('title', u'')), []).append(article)
+            failed = set(title for values in searcher.failed_batches for title in values)
+            for key, item in batch:
+                if item['title'] in failed:
+                    self.counts['failed'] += 1
+                    continue
+                results = found.get(self.normalize_title(item['title']))
+                if results:
+                    self.write(key, 'search', results)
+                else:
+                    self.write_none(key, [])
+
+    def search_dois(self, papers):
+        """Search for papers by DOI one at a time, since search results do not include DOIs."""
+
+        for key, item in papers:
+            articles, npages = self.get_searcher().query_for_field([item], 'doi', 'DO', batch_size=1)
+            if articles == -1:
+                self.counts['failed'] += 1
+                continue
+            if articles:
+                self.write(key, 'search', articles)
+            else:
+                self.write_none(key, articles)
+
+    def search_pairs(self, pairs):
+        """Search for author pairs in batches (see WebOfKnowledgeSearcher.query_for_author_pairs)."""
+
+        if not pairs:
+            return
+        results = self.get_searcher().query_for_author_pairs([(item['author1'], item['author2']) for key, item in pairs])
+        for (key, item), (articles, npages) in zip(pairs, results):
+            if articles == -1:
+                self.counts['failed'] += 1
+                continue
+            self.write(key, 'search' if articles else 'none', articles)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Query WoK for papers and author pairs in a resumable batch.")
+    parser.add_argument('input', help="JSONL or CSV file with papers (doi, pmid, ut, title) or author pairs (author1, author2)")
+    parser.add_argument('output', help="JSONL file that results are appended to")
+    parser.add_argument('--journal', default=None, help="file with the keys of completed items (default is the output with .journal)")
+    parser.add_argument('--cache', default=None, help="SQLite cache for LAMR and search results")
+    parser.add_argument('--chunk-size', type=int, default=BatchRunner.chunk_size, help="number of items routed together")
+    parser.add_argument('--order', default=','.join(BatchRunner.id_order), help="IDs to resolve papers by with LAMR, in order")
+    parser.add_argument('--no-search', action='store_true', help="only use LAMR, without any searches")
+    args = parser.parse_args()
+
+    runner = BatchRunner(args.output, journal=args.journal, cache=args.cache, search=not args.no_search)
+    runner.chunk_size = args.chunk_size
+    runner.id_order = tuple(args.order.split(','))
+    try:
+        runner.run(read_items(args.input))
+    finally:
+        runner.close()
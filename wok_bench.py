@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the WoK clients against local stand-in servers.
+
+Each client (WebOfKnowledgeSearcher, WebOfScienceAPI and WokmwsSoapClient) is run
+against a mock server on localhost that mimics the real service closely enough for
+the client to do all its usual work: the WoK server hands out SID cookies and query IDs
+and serves search and summary pages with the same markup as the real ones, the LAMR
+server returns papers in shuffled order and the SOAP server serves WSDLs and paged results.
+The servers can add latency, errors (HTTP 500) and connection resets to any request.
+
+Every combination of client and batch size runs in a separate process, so that the
+peak memory reported for it is its own. For example:
+
+    python wok_bench.py --clients search,lamr --latency 0.02 --error-rate 0.01
+"""
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import argparse
+import collections
+import gzip
+import hashlib
+import json
+import multiprocessing
+import random
+import re
+import resource
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import urlparse
+
+from StringIO import StringIO
+
+from wok_http import HTTPTransport
+from wok_lamr import WebOfScienceAPI
+from wok_metrics import default_metrics
+from wok_search import WebOfKnowledgeSearcher
+from wok_soap import SessionHolder, SessionTransport, WokmwsSoapClient
+from wok_throttle import RandomJitterThrottle
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server on a free local port, which can misbehave on purpose.
+
+    Each request is delayed by latency plus a random jitter (in seconds), and then fails
+    with an HTTP 500 error or has its connection reset with the given probabilities.
+    The number of requests, errors and resets are counted in self.counts.
+    """
+
+    daemon_threads = True
+
+    # Clients open many connections at once, which should not be dropped and retried.
+    request_queue_size = 128
+
+    def __init__(self, handler, latency=0.0, jitter=0.0, error_rate=0.0, reset_rate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    url = property(lambda self: 'http://127.0.0.1:%i' % self.server_address[1])
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+            return self.counts[key]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Errors from connections that are reset on purpose are expected.
+        pass
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler that applies the misbehavior of MockServer before respond() is called."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # Headers and bodies are written separately, which together with delayed ACKs
+        # would add tens of milliseconds to each response without TCP_NODELAY.
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        server.count('requests')
+        time.sleep(server.latency + server.jitter*random.random())
+        if random.random() < server.reset_rate:
+            server.count('resets')
+            return self.reset()
+        if random.random() < server.error_rate:
+            server.count('errors')
+            return self.reply('Internal Server Error', status=500)
+        self.respond(method, urlparse.urlparse(self.path), body)
+
+    def reset(self):
+        """Close the connection with a TCP reset instead of sending a response."""
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.connection.close()
+        self.close_connection = 1
+
+    def reply(self, body, status=200, content_type='text/html; charset=utf-8', headers=()):
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buffer = StringIO()
+            compressed = gzip.GzipFile(fileobj=buffer, mode='wb')
+            compressed.write(body)
+            compressed.close()
+            body = buffer.getvalue()
+            headers = list(headers) + [('Content-Encoding', 'gzip')]
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond(self, method, url, body):
+        raise NotImplementedError
+
+
+class WoKHandler(MockHandler):
+    """Stand-in for the WoK search pages (UA_GeneralSearch.do and summary.do).
+
+    The home page sets a new SID cookie, and each search POST gets the next query ID.
+    A search has results_per_value results for each value stacked with OR (see
+    create_query_data), and its pages use the markup of search results recorded from WoK.
+    """
+
+    item = u'''<div class="search-results-item">
+ <div class="search-results-content"><div><a class="smallV110" href="/full_record.do?product=UA&amp;qid=%(qid)i&amp;doc=%(i)i"><value lang_id="">Benchmark paper &amp; result <b>%(i)i</b> of query %(qid)i</value></a></div>
+ <div><span class="label">By: </span><a href="/OneClickSearch.do?value=Einstein">Einstein, A</a>; <a>Schrodinger, E</a>; <a>Bohr, N</a></div>
+ <div><span class="label">Volume: </span><span class="data_bold"><value>%(i)i</value></span>
+ <span class="label">Pages: </span><span class="data_bold"><value>%(i)i-%(j)i</value></span>
+ <span class="label">Published: </span><span class="data_bold"><value>MAY %(year)i</value></span></div>
+ <!-- End of search-results-content -->
+ </div>
+ <div class="search-results-data"><div class="search-results-data-cite">Times Cited: %(cited)i (from All Databases)</div></div>
+</div>
+'''
+
+    page = u'''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html><head><title>Web of Science [v.5.13] - All Databases Results</title>
+<script type="text/javascript">var searchMode = "<div>GeneralSearch</div>";</script></head>
+<body><form name="summary_navigation"><a href="summary.do?product=UA&amp;parentProduct=UA&amp;search_mode=GeneralSearch&qid=%(qid)i&SID=%(SID)s&page=%(page)i">Refresh</a>
+<span id="pageCount.top">%(pagecount)i</span></form>
+%(items)s
+</body></html>
+'''
+
+    empty = u'''<html><head><title>Web of Science</title></head><body><div class="newErrorHead">Your search found no records.</div></body></html>'''
+
+    def respond(self, method, url, body):
+        server = self.server
+        if url.path in ('', '/'):
+            SID = 'BENCH%i' % server.count('sessions')
+            return self.reply('<html><body>Welcome</body></html>', headers=[('Set-Cookie', 'SID=%s; Path=/' % SID)])
+
+        if url.path.endswith('UA_GeneralSearch.do'):
+            data = dict(urlparse.parse_qsl(body))
+            nvalues = 1 + sum(1 for k, v in data.items() if k.startswith('value(bool') and v == 'OR')
+            qid = server.count('queries')
+            with server.lock:
+                server.queries[qid] = [nvalues * server.results_per_value, 10]
+            return self.show(data.get('SID', ''), qid, 1)
+
+        if url.path.endswith('summary.do'):
+            query = dict(urlparse.parse_qsl(url.query))
+            qid = int(query['qid'])
+            if query.get('action') == 'changePageSize':
+                server.queries[qid][1] = int(query['pageSize'])
+                return self.show(query.get('SID', ''), qid, 1)
+            return self.show(query.get('SID', ''), qid, int(query['page']))
+
+        self.reply('Not Found', status=404)
+
+    def show(self, SID, qid, page):
+        nresults, pagesize = self.server.queries[qid]
+        if not nresults:
+            return self.reply(self.empty.encode('utf-8'))
+        first = (page-1) * pagesize
+        items = [self.item % {'qid' : qid, 'i' : i, 'j' : i+7, 'year' : 1900 + i % 100, 'cited' : i % 50}
+                 for i in range(first, min(nresults, first + pagesize))]
+        pagecount = (nresults + pagesize - 1) // pagesize
+        html = self.page % {'qid' : qid, 'SID' : SID, 'page' : page, 'pagecount' : pagecount, 'items' : u''.join(items)}
+        self.reply(html.encode('utf-8'))
+
+
+class LAMRHandler(MockHandler):
+    """Stand-in for the LAMR API (LinksAMR.retrieve), which returns papers in shuffled order.
+
+    A fraction miss_rate of the IDs (chosen by their hash, so always the same ones) are not found.
+    """
+
+    head = '<?xml version="1.0" encoding="UTF-8" ?><response xmlns="http://www.isinet.com/xrpc42"><fn name="LinksAMR.retrieve" rc="OK"><map>'
+    found = '<map name="%s"><map name="WOS"><val name="timesCited">%i</val><val name="ut">%s</val><val name="doi">%s</val><val name="pmid">%s</val></map></map>'
+    missing = '<map name="%s"><map name="WOS"><val name="message">No Result Found</val></map></map>'
+    tail = '</map></fn></response>'
+
+    def respond(self, method, url, body):
+        server = self.server
+        server.count('queries')
+        papers = re.findall(r'<map name="(\d+)"><val name="(\w+)">([^<]*)</val></map>', body)
+        random.shuffle(papers)
+        parts = [self.head]
+        for name, idname, value in papers:
+            number = int(hashlib.md5(value).hexdigest()[:8], 16) % 1000
+            if number < 1000 * server.miss_rate:
+                parts.append(self.missing % name)
+                continue
+            ids = {'ut' : '000%09i' % number, 'doi' : '10.1000/bench.%i' % number, 'pmid' : str(number)}
+            ids[idname] = value
+            parts.append(self.found % (name, number % 50, ids['ut'], ids['doi'], ids['pmid']))
+        parts.append(self.tail)
+        self.reply(''.join(parts), content_type='text/xml')
+
+
+class SOAPHandler(MockHandler):
+    """Stand-in for the WoK web services (WOKMWSAuthenticate and WokSearchLite).
+
+    The WSDLs define only what WokmwsSoapClient uses. Each search finds the number of
+    records given as records=N in the query (or default_records), which are then
+    retrieved in pages of up to 100 by the query ID.
+    """
+
+    auth_ns = 'http://auth.cxf.wokmws.thomsonreuters.com'
+    search_ns = 'http://woksearchlite.v3.wokmws.thomsonreuters.com'
+
+    auth_types = (
+        '<xs:element name="authenticate"><xs:complexType><xs:sequence/></xs:complexType></xs:element>'
+        '<xs:element name="authenticateResponse"><xs:complexType><xs:sequence><xs:element name="return" type="xs:string"/></xs:sequence></xs:complexType></xs:element>'
+        '<xs:element name="closeSession"><xs:complexType><xs:sequence/></xs:complexType></xs:element>'
+        '<xs:element name="closeSessionResponse"><xs:complexType><xs:sequence/></xs:complexType></xs:element>'
+    )
+
+    search_types = (
+        '<xs:complexType name="editionDesc"><xs:sequence><xs:element name="collection" type="xs:string"/><xs:element name="edition" type="xs:string"/></xs:sequence></xs:complexType>'
+        '<xs:complexType name="queryParameters"><xs:sequence><xs:element name="databaseID" type="xs:string"/><xs:element name="userQuery" type="xs:string"/>'
+        '<xs:element name="editions" type="tns:editionDesc" minOccurs="0" maxOccurs="unbounded"/><xs:element name="queryLanguage" type="xs:string"/></xs:sequence></xs:complexType>'
+        '<xs:complexType name="sortField"><xs:sequence><xs:element name="name" type="xs:string"/><xs:element name="sort" type="xs:string"/></xs:sequence></xs:complexType>'
+        '<xs:complexType name="retrieveParameters"><xs:sequence><xs:element name="firstRecord" type="xs:int"/><xs:element name="count" type="xs:int"/>'
+        '<xs:element name="fields" type="tns:sortField" minOccurs="0" maxOccurs="unbounded"/></xs:sequence></xs:complexType>'
+        '<xs:complexType name="labelValues"><xs:sequence><xs:element name="label" type="xs:string"/><xs:element name="value" type="xs:string" maxOccurs="unbounded"/></xs:sequence></xs:complexType>'
+        '<xs:complexType name="liteRecord"><xs:sequence><xs:element name="uid" type="xs:string"/><xs:element name="title" type="tns:labelValues" maxOccurs="unbounded"/></xs:sequence></xs:complexType>'
+        '<xs:complexType name="searchResults"><xs:sequence><xs:element name="queryId" type="xs:string"/><xs:element name="recordsFound" type="xs:int"/><xs:element name="recordsSearched" type="xs:long"/>'
+        '<xs:element name="records" type="tns:liteRecord" minOccurs="0" maxOccurs="unbounded"/></xs:sequence></xs:complexType>'
+        '<xs:element name="search"><xs:complexType><xs:sequence><xs:element name="queryParameters" type="tns:queryParameters"/><xs:element name="retrieveParameters" type="tns:retrieveParameters"/></xs:sequence></xs:complexType></xs:element>'
+        '<xs:element name="searchResponse"><xs:complexType><xs:sequence><xs:element name="return" type="tns:searchResults"/></xs:sequence></xs:complexType></xs:element>'
+        '<xs:element name="retrieve"><xs:complexType><xs:sequence><xs:element name="queryId" type="xs:string"/><xs:element name="retrieveParameters" type="tns:retrieveParameters"/></xs:sequence></xs:complexType></xs:element>'
+        '<xs:element name="retrieveResponse"><xs:complexType><xs:sequence><xs:element name="return" type="tns:searchResults"/></xs:sequence></xs:complexType></xs:element>'
+    )
+
+    envelope = '<?xml version="1.0" encoding="UTF-8"?><soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>%s</soap:Body></soap:Envelope>'
+    record = '<records><uid>WOS:%012i</uid><title><label>Title</label><value>Benchmark record %i of query %s</value></title></records>'
+
+    default_records = 250
+
+    def wsdl(self, namespace, name, operations, types, location):
+        messages = ''.join(
+            '<wsdl:message name="%s"><wsdl:part name="parameters" element="tns:%s"/></wsdl:message>'
+            '<wsdl:message name="%sResponse"><wsdl:part name="parameters" element="tns:%sResponse"/></wsdl:message>' % (op, op, op, op) for op in operations)
+        porttype = ''.join(
+            '<wsdl:operation name="%s"><wsdl:input message="tns:%s"/><wsdl:output message="tns:%sResponse"/></wsdl:operation>' % (op, op, op) for op in operations)
+        binding = ''.join(
+            '<wsdl:operation name="%s"><soap:operation soapAction=""/><wsdl:input><soap:body use="literal"/></wsdl:input>'
+            '<wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>' % op for op in operations)
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+            'xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="%(ns)s" targetNamespace="%(ns)s" name="%(name)s">'
+            '<wsdl:types><xs:schema targetNamespace="%(ns)s" elementFormDefault="unqualified">%(types)s</xs:schema></wsdl:types>%(messages)s'
+            '<wsdl:portType name="%(name)sPort">%(porttype)s</wsdl:portType>'
+            '<wsdl:binding name="%(name)sBinding" type="tns:%(name)sPort"><soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>%(binding)s</wsdl:binding>'
+            '<wsdl:service name="%(name)s"><wsdl:port name="%(name)sPort" binding="tns:%(name)sBinding"><soap:address location="%(location)s"/></wsdl:port></wsdl:service>'
+            '</wsdl:definitions>'
+        ) % {'ns' : namespace, 'name' : name, 'types' : types, 'messages' : messages, 'porttype' : porttype, 'binding' : binding, 'location' : location}
+
+    def respond(self, method, url, body):
+        server = self.server
+
+        if method == 'GET':
+            if url.path.startswith('/auth'):
+                wsdl = self.wsdl(self.auth_ns, 'WOKMWSAuthenticateService', ['authenticate', 'closeSession'], self.auth_types, server.url + '/auth')
+            else:
+                wsdl = self.wsdl(self.search_ns, 'WokSearchLiteService', ['search', 'retrieve'], self.search_types, server.url + '/search')
+            return self.reply(wsdl, content_type='text/xml')
+
+        operation = re.search(r'<(?:\w+:)?(authenticate|closeSession|search|retrieve)\b', body).group(1)
+        if operation == 'authenticate':
+            SID = 'BENCH%i' % server.count('sessions')
+            content = '<ns:authenticateResponse xmlns:ns="%s"><return>%s</return></ns:authenticateResponse>' % (self.auth_ns, SID)
+        elif operation == 'closeSession':
+            content = '<ns:closeSessionResponse xmlns:ns="%s"/>' % self.auth_ns
+        else:
+            if operation == 'search':
+                qid = str(server.count('queries'))
+                records = re.search(r'records=(\d+)', body)
+                with server.lock:
+                    server.queries[qid] = int(records.group(1)) if records else self.default_records
+            else:
+                qid = re.search(r'<queryId>([^<]*)</queryId>', body).group(1)
+            total = server.queries[qid]
+            first = int(re.search(r'<firstRecord>(\d+)</firstRecord>', body).group(1))
+            count = int(re.search(r'<count>(\d+)</count>', body).group(1))
+            records = ''.join(self.record % (i, i, qid) for i in range(first, min(total, first + count - 1) + 1))
+            content = ('<ns:%sResponse xmlns:ns="%s"><return><queryId>%s</queryId><recordsFound>%i</recordsFound><recordsSearched>%i</recordsSearched>%s</return></ns:%sResponse>'
+                       % (operation, self.search_ns, qid, total, 10 * total, records, operation))
+        self.reply(self.envelope % content, content_type='text/xml; charset=utf-8')
+
+
+def start_server(handler, options, **attributes):
+    server = MockServer(handler, latency=options.latency, jitter=options.jitter, error_rate=options.error_rate, reset_rate=options.reset_rate)
+    server.queries = {}
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    return server.start()
+
+
+class Timings:
+    """Latencies (in seconds) recorded for each stage of a benchmark, from any thread.
+
+    Queries that failed as a whole are counted separately, since their items are missing.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = collections.defaultdict(list)
+        self.failed = 0
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage].append(seconds)
+
+    def fail(self):
+        with self.lock:
+            self.failed += 1
+
+    def timed(self, stage, func):
+        """Wrap a function so that the time spent in each call is recorded for a stage."""
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.time() - started)
+        return wrapper
+
+
+def percentile(values, q):
+    """Return the q-th percentile of a list of values (nearest rank), or None if it is empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values)-1, max(0, int(round(q / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def bench_search(server, size, options, timings):
+    """Query for titles in batches of size values, nqueries times. Returns (queries, items)."""
+
+    class BenchSearcher(WebOfKnowledgeSearcher):
+        wokurl = server.url + '/'
+        searchurl = server.url + '/UA_GeneralSearch.do'
+        summaryurl = server.url + '/summary.do'
+        cookie_domain = '127.0.0.1'
+
+    throttle = RandomJitterThrottle(probability=0.0, delay=0.0, reset_delay=0.0, reset_jitter=0.0)
+    searcher = BenchSearcher(logfunc=lambda msg: None, throttle=throttle, transport=HTTPTransport(), page_workers=options.page_workers)
+    searcher._request = timings.timed('request', searcher._request)
+    searcher.parser.parse = timings.timed('parse', searcher.parser.parse)
+    searcher.parse_article_data = timings.timed('extract', searcher.parse_article_data)
+
+    papers = [{'title' : 'benchmark title %i' % i} for i in range(size * options.nqueries)]
+    articles, npages = searcher.query_for_field(papers, 'title', 'TI', batch_size=size)
+    for batch in searcher.failed_batches:
+        timings.fail()
+    return searcher.query_count, len(articles) if articles != -1 else 0
+
+
+def bench_lamr(server, size, options, timings):
+    """Resolve size papers by DOI, then PMID, nqueries times. Returns (requests, papers found)."""
+
+    class BenchAPI(WebOfScienceAPI):
+        url = server.url + '/cps/xrpc'
+        retry_delay = 0.01
+
+    transport = HTTPTransport()
+    found = 0
+    for iquery in range(options.nqueries):
+        papers = [{'doi' : '10.1000/bench.%i.%i' % (iquery, i), 'pmid' : str(iquery * size + i)} for i in range(size)]
+        api = BenchAPI(papers, transport=transport)
+        api.post_request = timings.timed('request', api.post_request)
+        parse = api.iter_response_papers
+        api.iter_response_papers = timings.timed('parse', lambda res: list(parse(res)))
+        found += sum(1 for p in api.resolve(order=('doi', 'pmid')) if p)
+    return len(timings.stages['request']), found
+
+
+def bench_soap(server, size, options, timings):
+    """Retrieve all size records of a search, nqueries times. Returns (requests, records)."""
+
+    cache = tempfile.mkdtemp()
+
+    class BenchClient(WokmwsSoapClient):
+        url = {'auth' : server.url + '/auth?wsdl', 'search' : server.url + '/search?wsdl'}
+        wsdl_cache = cache
+
+    # Sending is timed for each thread, so that the rest of each call can be counted as parsing.
+    sent = threading.local()
+    send = SessionTransport.send
+    def timed_send(transport, request):
+        started = time.time()
+        try:
+            return send(transport, request)
+        finally:
+            sent.seconds = getattr(sent, 'seconds', 0.0) + time.time() - started
+            timings.add('request', time.time() - started)
+    SessionTransport.send = timed_send
+
+    def timed_call(func):
+        def wrapper(*args, **kwargs):
+            sent.seconds = 0.0
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.add('parse', time.time() - started - sent.seconds)
+        return wrapper
+
+    # The client is created in the first query, since loading the WSDLs can fail, too.
+    try:
+        client = None
+        records = 0
+        for iquery in range(options.nqueries):
+            try:
+                if client is None:
+                    client = BenchClient(transport=HTTPTransport(), sessions=SessionHolder())
+                    client.search = timed_call(client.search)
+                    client.retrieve = timed_call(client.retrieve)
+                records += len(client.search_all('TS=(benchmark %i) records=%i' % (iquery, size)))
+            except Exception:
+                timings.fail()
+        return len(timings.stages['request']), records
+    finally:
+        SessionTransport.send = send
+        shutil.rmtree(cache, ignore_errors=True)
+
+
+benchmarks = {
+    'search' : (bench_search, WoKHandler, [1, 10, 50]),
+    'lamr' : (bench_lamr, LAMRHandler, [50, 500, 5000]),
+    'soap' : (bench_soap, SOAPHandler, [100, 1000, 5000]),
+}
+
+
+def run_case(name, server, size, options, results):
+    """Run one benchmark in this process and put its results on a queue."""
+
+    timings = Timings()
+    default_metrics.reset()
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.time()
+    queries, items = benchmarks[name][0](server, size, options, timings)
+    elapsed = time.time() - started
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    result = {
+        'client' : name,
+        'size' : size,
+        'elapsed' : elapsed,
+        'queries' : queries,
+        'items' : items,
+        'qps' : queries / elapsed,
+        'items_per_second' : items / elapsed,
+        'failed' : timings.failed,
+        'peak_mb' : rss_peak / 1024.0,
+        'growth_mb' : (rss_peak - rss_start) / 1024.0,
+        'metrics' : default_metrics.snapshot(),
+    }
+    for stage, values in timings.stages.items():
+        result[stage] = dict(('p%i' % q, percentile(values, q)) for q in (50, 90, 99))
+        result[stage]['count'] = len(values)
+    results.put(result)
+
+
+def run(options):
+    """Run all benchmarks, each client and size in a separate process, and return the results."""
+
+    results = []
+    for name in options.clients:
+        benchmark, handler, sizes = benchmarks[name]
+        server = start_server(handler, options, results_per_value=options.results_per_value, miss_rate=options.miss_rate)
+        try:
+            for size in options.sizes or sizes:
+                counts = server.counts.copy()
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=run_case, args=(name, server, size, options, queue))
+                process.start()
+                result = wait_result(process, queue)
+                process.join()
+                if result is None:
+                    result = {'client' : name, 'size' : size, 'exitcode' : process.exitcode}
+                for key in ('requests', 'errors', 'resets'):
+                    result['server_' + key] = server.counts[key] - counts[key]
+                results.append(result)
+                report(result)
+        finally:
+            server.stop()
+    return results
+
+
+def wait_result(process, queue, poll=1.0):
+    """Return the result a process puts on a queue, or None if it exits without one."""
+    while True:
+        try:
+            return queue.get(True, poll)
+        except Queue.Empty:
+            if not process.is_alive():
+                break
+    try:
+        return queue.get(True, poll)
+    except Queue.Empty:
+        return None
+
+
+def report(result):
+    if 'exitcode' in result:
+        print "%-6s size %5i: failed, the benchmark process exited with code %s" % (result['client'], result['size'], result['exitcode'])
+        return
+    ms = lambda value: '%8.1f' % (1000 * value) if value is not None else '%8s' % '-'
+    stages = []
+    for stage in ('request', 'parse', 'extract'):
+        if stage in result:
+            stages.append('%s p50/p90/p99 %s%s%s ms' % (stage, ms(result[stage]['p50']), ms(result[stage]['p90']), ms(result[stage]['p99'])))
+    print "%-6s size %5i: %6i queries, %7i items in %6.2f s, %8.1f queries/s, %9.1f items/s, peak %6.1f MB (+%.1f), %i failed, %i errors, %i resets" % (
+        result['client'], result['size'], result['queries'], result['items'], result['elapsed'], result['qps'], result['items_per_second'],
+        result['peak_mb'], result['growth_mb'], result['failed'], result['server_errors'], result['server_resets'])
+    if result['failed']:
+        print "    %i queries failed as a whole, so their items are missing from the figures" % result['failed']
+    for line in stages:
+        print "    " + line
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the WoK clients against local stand-in servers.")
+    parser.add_argument('--clients', default='search,lamr,soap', help="comma-separated clients to run (search, lamr, soap)")
+    parser.add_argument('--sizes', default=None, help="comma-separated batch sizes (default depends on client)")
+    parser.add_argument('--nqueries', type=int, default=10, help="number of batches per client and size")
+    parser.add_argument('--latency', type=float, default=0.01, help="server latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests that fail with HTTP 500")
+    parser.add_argument('--reset-rate', type=float, default=0.0, help="fraction of connections that are reset")
+    parser.add_argument('--results-per-value', type=int, default=3, help="WoK search results for each value in a query")
+    parser.add_argument('--miss-rate', type=float, default=0.1, help="fraction of IDs not found by LAMR")
+    parser.add_argument('--page-workers', type=int, default=1, help="page workers for WoK searches")
+    parser.add_argument('--json', default=None, help="also write all results to this file")
+    options = parser.parse_args()
+
+    options.clients = options.clients.split(',')
+    options.sizes = [int(s) for s in options.sizes.split(',')] if options.sizes else None
+
+    results = run(options)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2)
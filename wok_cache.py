@@ -0,0 +1,195 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class SQLiteCache:
+    """Persistent key-value store for parsed responses, backed by a local SQLite file.
+
+    Keys and values are anything that can be serialized to JSON. Entries older than
+    the TTL (in seconds) are treated as missing, and the least recently used entries
+    are evicted when the number of entries grows beyond max_entries.
+    """
+
+    table = "cache"
+
+    # Evicting entries counts and scans the whole table, so it is only done after this many
+    # entries were written (or a tenth of max_entries, if that is fewer), which means the cache
+    # can briefly hold a few more entries than max_entries.
+    evict_interval = 1000
+
+    # The most keys that are looked up in one query, well below the limit of 999 SQLite variables.
+    lookup_size = 500
+
+    def __init__(self, path, ttl=7*24*3600, max_entries=100000):
+
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        # The number of entries written since the last eviction.
+        self.unevicted = 0
+
+        # The same cache can be shared between threads (for example by several searchers),
+        # so serialize access to the connection with a lock instead of opening one per thread.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)" % self.table)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS %s_accessed ON %s (accessed)" % (self.table, self.table))
+        self.connection.commit()
+
+    def hash_key(self, key):
+        """Hash any JSON-serializable key, so that it has a fixed size in the database."""
+        return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def get(self, key):
+        """Return the value stored for a key, or None if it is missing or has expired."""
+
+        hashed = self.hash_key(key)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT value, created FROM %s WHERE key=?" % self.table, (hashed,)).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.connection.execute("UPDATE %s SET accessed=? WHERE key=?" % self.table, (now, hashed))
+            self.connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def get_many(self, keys):
+        """Return a list with the value stored for each key, or None if it is missing or has expired.
+
+        This is much faster than calling get for each key, since keys are looked up with one
+        query and their access times updated with one commit for every lookup_size keys.
+        """
+
+        hashed = [self.hash_key(key) for key in keys]
+        now = time.time()
+        found = {}
+        with self.lock:
+            for i in range(0, len(hashed), self.lookup_size):
+                chunk = hashed[i:i+self.lookup_size]
+                params = ','.join('?' * len(chunk))
+                rows = self.connection.execute("SELECT key, value, created FROM %s WHERE key IN (%s)" % (self.table, params), chunk).fetchall()
+                fresh = dict((row[0], row[1]) for row in rows if not (self.ttl and now - row[2] > self.ttl))
+                if fresh:
+                    params = ','.join('?' * len(fresh))
+                    self.connection.execute("UPDATE %s SET accessed=? WHERE key IN (%s)" % (self.table, params), [now] + fresh.keys())
+                    self.connection.commit()
+                found.update(fresh)
+            nfound = sum(h in found for h in hashed)
+            self.hits += nfound
+            self.misses += len(hashed) - nfound
+        return [json.loads(found[h]) if h in found else None for h in hashed]
+
+    def put(self, key, value):
+        """Store a value for a key, evicting old entries if the cache is too large."""
+
+        hashed = self.hash_key(key)
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?)" % self.table, (hashed, json.dumps(value), now, now))
+            self._written(1, now)
+            self.connection.commit()
+
+    def put_many(self, items):
+        """Store many (key, value) pairs at once, which is much faster than one at a time."""
+
+        now = time.time()
+        rows = [(self.hash_key(key), json.dumps(value), now, now) for key, value in items]
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?)" % self.table, rows)
+            self._written(len(rows), now)
+            self.connection.commit()
+
+    def _written(self, nentries, now):
+        """Count entries that were written, and evict entries once there were enough of them."""
+
+        self.unevicted += nentries
+        if self.unevicted >= max(1, min(self.evict_interval, (self.max_entries or 0) // 10)):
+            self._evict(now)
+            self.unevicted = 0
+
+    def _evict(self, now):
+        """Drop expired entries, and then the least recently used ones above max_entries."""
+
+        if self.ttl:
+            self.connection.execute("DELETE FROM %s WHERE created < ?" % self.table, (now - self.ttl,))
+        if self.max_entries:
+            count = self.connection.execute("SELECT COUNT(*) FROM %s" % self.table).fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute("DELETE FROM %s WHERE key IN (SELECT key FROM %s ORDER BY accessed LIMIT ?)" % (self.table, self.table), (count - self.max_entries,))
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM %s" % self.table)
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class QueryCache(SQLiteCache):
+    """Cache of WebOfKnowledgeSearcher query results, keyed on the POSTed query data.
+
+    The session and query IDs change all the time and do not affect the results,
+    so they are left out of the key. All other values are normalized for whitespace
+    and case, since WoK searches are not sensitive to either of them.
+    """
+
+    volatile_fields = ('SID', 'qid')
+
+    def __init__(self, path="wok_cache.sqlite", ttl=7*24*3600, max_entries=100000):
+        SQLiteCache.__init__(self, path, ttl=ttl, max_entries=max_entries)
+
+    def normalize(self, value):
+        if isinstance(value, str):
+            value = value.decode('utf-8', 'replace')
+        return ' '.join(unicode(value).split()).lower()
+
+    def query_key(self, data):
+        return sorted((k, self.normalize(v)) for k, v in data.items() if k not in self.volatile_fields)
+
+    def get_query(self, data):
+        """Return the cached (article_data, pagecount) tuple for the query data, or None."""
+        cached = self.get(self.query_key(data))
+        if cached is None:
+            return None
+        return cached[0], cached[1]
+
+    def put_query(self, data, article_data, pagecount):
+        self.put(self.query_key(data), [article_data, pagecount])
+
+
+class IDCache(SQLiteCache):
+    """Cache of papers resolved by ID with the WoS LAMR API, keyed on the type and value of the ID.
+
+    IDs that were not found are cached as well, as empty dicts, so that they are not
+    requested again before they expire. The values of IDs should be normalized already.
+    """
+
+    table = "ids"
+
+    def __init__(self, path="wok_cache.sqlite", ttl=30*24*3600, max_entries=1000000):
+        SQLiteCache.__init__(self, path, ttl=ttl, max_entries=max_entries)
+
+    def get_id(self, idname, value):
+        """Return the cached paper for an ID (empty if it was not found), or None if it is unknown."""
+        return self.get([idname, value])
+
+    def get_ids(self, idname, values):
+        """Return a dict with the cached paper for each ID that is known (empty if it was not found)."""
+        values = list(values)
+        cached = self.get_many([idname, value] for value in values)
+        return dict((value, paper) for value, paper in zip(values, cached) if paper is not None)
+
+    def put_ids(self, idname, papers):
+        """Store papers for a dict of IDs, using None or an empty dict for those not found."""
+        self.put_many(([idname, value], paper or {}) for value, paper in papers.items())
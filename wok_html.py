@@ -0,0 +1,193 @@
+import re
+
+from BeautifulSoup import BeautifulSoup
+
+
+class SoupBackend:
+    """Parse search result pages with BeautifulSoup.
+
+    This is the reference backend, which was always used before there were others,
+    except that now each page is parsed only once for both pagecounts and results.
+    """
+
+    def parse(self, response):
+        """Return a list of pagecount elements and a list of search result items in a page."""
+        soup = BeautifulSoup(response)
+        pagecounts = soup.findAll("span", { "id" : "pageCount.top" })
+        results = soup.findAll("div", { "class" : "search-results-item" })
+        return pagecounts, results
+
+
+class Tag:
+    """A lightweight element in a tree built by StreamBackend.
+
+    This supports the small part of the BeautifulSoup API used for extracting article data
+    (findAll, parent, text and getText) with the same semantics, in particular the text
+    of an element is all the strings inside it stripped and joined with the separator.
+    """
+
+    __slots__ = ('name', 'attrs', 'parent', 'contents')
+
+    def __init__(self, name, attrs, parent):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.contents = []
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def strings(self):
+        for child in self.contents:
+            if isinstance(child, Tag):
+                for s in child.strings():
+                    yield s
+            else:
+                yield child
+
+    def getText(self, separator=u""):
+        return separator.join(s.strip() for s in self.strings())
+
+    text = property(getText)
+
+    def descendants(self):
+        for child in self.contents:
+            if isinstance(child, Tag):
+                yield child
+                for tag in child.descendants():
+                    yield tag
+
+    def findAll(self, name, attrs=None):
+        """Find all descendant elements with a name and exactly matching attribute values."""
+        attrs = attrs or {}
+        return [tag for tag in self.descendants() if tag.name == name and all(tag.attrs.get(k) == v for k, v in attrs.items())]
+
+
+class StreamBackend:
+    """Parse search result pages in a single pass with regular expressions.
+
+    Elements are built into a tree only inside the pagecount and search result item
+    elements (everything else is just tracked on a stack of open tags), which makes this
+    several times faster than BeautifulSoup. The tree follows the same rules as
+    BeautifulSoup version 3 for implicitly closing and nesting tags, and entities are
+    left unconverted in text, so the parsed article data is the same with both backends.
+    """
+
+    # These are the tag rules used by BeautifulSoup.BeautifulSoup (see its source for the background).
+    self_closing_tags = set(['br', 'hr', 'input', 'img', 'meta', 'spacer', 'link', 'frame', 'base', 'col'])
+    quote_tags = set(['script', 'textarea'])
+    nestable_tags = {
+        'span' : [], 'font' : [], 'q' : [], 'object' : [], 'bdo' : [], 'sub' : [], 'sup' : [], 'center' : [],
+        'blockquote' : [], 'div' : [], 'fieldset' : [], 'ins' : [], 'del' : [],
+        'ol' : [], 'ul' : [], 'li' : ['ul', 'ol'], 'dl' : [], 'dd' : ['dl'], 'dt' : ['dl'],
+        'table' : [], 'tr' : ['table', 'tbody', 'tfoot', 'thead'], 'td' : ['tr'], 'th' : ['tr'],
+        'thead' : ['table'], 'tbody' : ['table'], 'tfoot' : ['table'],
+    }
+    reset_nesting_tags = set(['blockquote', 'div', 'fieldset', 'ins', 'del', 'noscript', 'address', 'form', 'p', 'pre',
+                              'ol', 'ul', 'li', 'dl', 'dd', 'dt', 'table', 'tr', 'td', 'th', 'thead', 'tbody', 'tfoot'])
+
+    # Comments, declarations and processing instructions are all text for BeautifulSoup,
+    # and like there, a tag can also be ended by the start of the next one.
+    token = re.compile(r'<(?:!--(.*?)--\s*>|(/?)([a-zA-Z][-_.a-zA-Z0-9]*)([^<>]*)(?:>|(?=<)|$)|[!?]([^<>]*)>)', re.S)
+    attribute = re.compile(r'([a-zA-Z_][-:.a-zA-Z_0-9]*)(?:\s*=\s*(\'[^\']*\'|"[^"]*"|[^\s>]*))?')
+
+    # Entity and character references without a trailing semicolon get one in BeautifulSoup.
+    entityref = re.compile(r'&([a-zA-Z][-.a-zA-Z0-9]*|#[0-9]+)(?=[^-.a-zA-Z0-9;]|$)')
+
+    def decode(self, response):
+        if isinstance(response, unicode):
+            return response
+        try:
+            return response.decode('utf-8')
+        except UnicodeDecodeError:
+            return response.decode('windows-1252', 'replace')
+
+    def parse_attributes(self, text):
+        attrs = {}
+        for name, value in self.attribute.findall(text):
+            name = name.lower()
+            if name in attrs:
+                continue
+            if value[:1] in ('"', "'") and value[:1] == value[-1:]:
+                value = value[1:-1]
+            attrs[name] = value or name
+        return attrs
+
+    def parse(self, response):
+        """Return a list of pagecount elements and a list of search result items in a page."""
+
+        markup = self.decode(response)
+
+        root = Tag(u'[document]', {}, None)
+        stack = [root]
+        pagecounts, results = [], []
+
+        # Only the pagecount and search result item elements, and everything inside them,
+        # are kept in the tree, so only add children and text to the elements in this set.
+        kept = set()
+
+        def add_text(text):
+            if text and stack[-1] in kept:
+                stack[-1].contents.append(self.entityref.sub(r'&\1;', text))
+
+        def pop_to(name, inclusive=True):
+            for i in range(len(stack)-1, 0, -1):
+                if stack[i].name == name:
+                    del stack[i+(not inclusive):]
+                    return
+
+        def smart_pop(name):
+            triggers = self.nestable_tags.get(name)
+            reset = name in self.reset_nesting_tags
+            for tag in reversed(stack[1:]):
+                if triggers is None and tag.name == name:
+                    return pop_to(name)
+                if (triggers is not None and tag.name in triggers) or (triggers is None and reset and tag.name in self.reset_nesting_tags):
+                    return pop_to(tag.name, inclusive=False)
+
+        position = 0
+        length = len(markup)
+        while position < length:
+
+            match = self.token.search(markup, position)
+            if not match:
+                add_text(markup[position:])
+                break
+            add_text(markup[position:match.start()])
+            position = match.end()
+
+            comment, closing, name, attrs, declaration = match.groups()
+            if name is None:
+                add_text(comment if comment is not None else declaration)
+                continue
+            name = name.lower()
+
+            if closing:
+                pop_to(name)
+                continue
+
+            if name not in self.self_closing_tags:
+                smart_pop(name)
+
+            parent = stack[-1]
+            tag = Tag(name, self.parse_attributes(attrs), parent)
+            if parent in kept:
+                parent.contents.append(tag)
+                kept.add(tag)
+            if name == 'span' and tag.attrs.get('id') == 'pageCount.top':
+                pagecounts.append(tag)
+                kept.add(tag)
+            elif name == 'div' and tag.attrs.get('class') == 'search-results-item':
+                results.append(tag)
+                kept.add(tag)
+            if name not in self.self_closing_tags:
+                stack.append(tag)
+
+            # The contents of scripts are text, up to the closing tag.
+            if name in self.quote_tags:
+                end = re.compile(r'</%s\s*>' % name, re.I).search(markup, position)
+                end = end.start() if end else length
+                add_text(markup[position:end])
+                position = end
+
+        return pagecounts, results
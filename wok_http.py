@@ -0,0 +1,35 @@
+import requests
+
+from requests.adapters import HTTPAdapter
+
+
+class HTTPTransport:
+    """A pool of keep-alive HTTP connections that can be shared by many sessions.
+
+    Each session created here has its own cookies and headers, but all of them reuse
+    connections from the same pools (one per host, each holding up to pool_maxsize
+    connections), so there is no new TCP and TLS handshake for every request. Responses
+    compressed with gzip or deflate are asked for, and they are decoded transparently.
+
+    Sessions from a transport should not be closed, since that closes the shared pools.
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=50):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+    def session(self, headers=None):
+        """Create a new session that uses the connection pools of this transport."""
+        session = requests.Session()
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        session.headers.update(headers or {})
+        return session
+
+
+# All clients use this transport unless they are given another one, so that they share
+# connections within a process. The pool size fits the largest number of threads
+# normally used for the LAMR API.
+default_transport = HTTPTransport()
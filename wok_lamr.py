@@ -1,12 +1,22 @@
-import threading
+import Queue
+import multiprocessing
 import time
 
+from multiprocessing.pool import ThreadPool
+
 import requests
 
 import xml.etree.cElementTree as et
 
 import ConfigParser
 
+from cStringIO import StringIO
+from xml.sax.saxutils import escape
+
+from wok_http import default_transport
+from wok_metrics import default_metrics
+from wok_throttle import ConcurrencyLimiter
+
 
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
@@ -26,137 +36,410 @@ class WebOfScienceAPI:
     # This might need to be tuned, I found 10-50 threads to be optimum.
     max_threads = 10
 
+    # Requests that fail with a ConnectionError are retried this many times, waiting
+    # for retry_delay seconds before the first retry and twice as long before each next one.
+    max_retries = 3
+    retry_delay = 0.5
+
+    # The number of seconds to wait for a whole batch of requests, or None to wait forever.
+    batch_timeout = None
+
+    # The parts of the XML request that are the same for all requests, which is the root
+    # element with the fields we want to come back (the UT, DOI and PMID with the citation
+    # count) and the map that holds the papers. This is the same XML that ElementTree produces.
+    request_head = (
+        "<?xml version='1.0' encoding='UTF-8'?>\n"
+        '<request src="app.id=MyApp,env.id=MyEnv,partner.email=myemail" xmlns="http://www.isinet.com/xrpc42">'
+        '<fn name="LinksAMR.retrieve"><list><map />'
+        '<map><list name="WOS"><val>ut</val><val>doi</val><val>pmid</val><val>timesCited</val><val>timesCited</val></list></map>'
+        '<map>'
+    )
+    request_paper = '<map name="%i"><val name="%s">%s</val></map>'
+    request_tail = '</map></list></fn></request>'
+
     url = "https://ws.isiknowledge.com/cps/xrpc"
-    post_request = lambda self, data: requests.post(self.url, data)
+    post_request = lambda self, data: self.session.post(self.url, data)
 
-    def __init__(self, papers):
+    def __init__(self, papers, transport=None, cache=None, metrics=None):
         self.papers = papers
         self.npapers = len(self.papers)
 
+        # An optional IDCache (see wok_cache.py) with papers resolved in earlier runs.
+        self.cache = cache
+
+        # Latencies, sizes, retries and parse times are recorded here (see wok_metrics.py),
+        # with names starting with 'lamr.'.
+        self.metrics = metrics or default_metrics
+
+        # Requests reuse keep-alive connections from a pool shared with other clients,
+        # which should hold at least as many connections as there are threads.
+        self.session = (transport or default_transport).session()
+
     def create_request_data(self, idname, vector):
-        """Create XML data consumable by the WOS API, specifying a paper by specific ID."""
-
-        src = 'app.id=MyApp,env.id=MyEnv,partner.email=myemail'
-
-        xml_request = et.Element('request', {'xmlns' : 'http://www.isinet.com/xrpc42', 'src' : src})
-        xml_fn = et.SubElement(xml_request, 'fn', {'name' : 'LinksAMR.retrieve'})
-        xml_list = et.SubElement(xml_fn, "list")
-        xml_who = et.SubElement(xml_list, "map")
-
-        # We want the UT, DOI and PMID to come back with the citation count.
-        xml_what = et.SubElement(xml_list, "map")
-        xml_wos = et.SubElement(xml_what, 'list', {'name':'WOS'})
-        xml_wos_ut = et.SubElement(xml_wos, "val")
-        xml_wos_ut.text = "ut"
-        xml_wos_doi = et.SubElement(xml_wos, "val")
-        xml_wos_doi.text = "doi"
-        xml_wos_pmid = et.SubElement(xml_wos, "val")
-        xml_wos_pmid.text = "pmid"
-        xml_wos_tc = et.SubElement(xml_wos, "val")
-        xml_wos_tc.text = "timesCited"
-        xml_wos_timescited = et.SubElement(xml_wos, "val")
-        xml_wos_timescited.text = "timesCited"
+        """Create XML data consumable by the WOS API, specifying a paper by specific ID.
+
+        Only the papers are formatted for each request, without building an element tree.
+        """
 
         # We are requesting data for a bunch of articles in one go here, each by the same id (UT/PMID/DOI).
         # The name of each paper is just the index in the vector passed to this method,
         # which needs to be used when parsing the response, since the order is not conserved.
-        xml_papers = et.SubElement(xml_list, "map")
+        parts = [self.request_head]
         for i,value in enumerate(vector):
-            xml_paper = et.SubElement(xml_papers, "map", { 'name' : str(i) })
-            xml_val = et.SubElement(xml_paper, "val", { 'name' : idname })
-            xml_val.text = value
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            parts.append(self.request_paper % (i, idname, escape(value)))
+        parts.append(self.request_tail)
+        return ''.join(parts)
+
+    def iter_request_data(self, idname, values):
+        """Generate the data for requests with up to request_limit papers each, one at a time.
+
+        This is not used by resolve (and fetch_by_id), which creates the data for each request
+        in a worker thread (see fetch_ids), but it is kept as public API for requests2responses.
+        """
+        for chunk in chunks(values, self.request_limit):
+            yield self.create_request_data(idname, chunk)
+
+    def post_with_retries(self, data):
+        """Send a request, retrying with exponential backoff after a ConnectionError.
+
+        Returns the response, or None when the request failed even after all retries.
+        """
+
+        for attempt in range(self.max_retries + 1):
+            started = time.time()
+            try:
+                response = self.post_request(data)
+            except requests.ConnectionError:
+                if attempt == self.max_retries:
+                    print "ConnectionError: giving up after %i retries." % self.max_retries
+                    self.metrics.count('lamr.request.errors')
+                    return None
+                delay = self.retry_delay * 2**attempt
+                print "ConnectionError: will retry in %.1f seconds." % delay
+                self.metrics.count('lamr.request.retries')
+                time.sleep(delay)
+                continue
+            self.metrics.observe('lamr.request.seconds', time.time() - started)
+            self.metrics.observe('lamr.request.bytes_sent', len(data))
+            self.metrics.observe('lamr.request.bytes', len(response.content))
+            return response
+
+    def requests2responses(self, request_data, max_threads=None, timeout=None):
+        """Throw data at the WOS API in several threads.
+
+        The requests (any iterable, for example from iter_request_data) are queued
+        for a pool of up to max_threads threads, and the responses are returned in the
+        same order as soon as the last one is finished. Each response is None if the request
+        failed (even after retries) or it did not finish before the timeout for the whole
+        batch (in seconds) ran out.
+
+        This is not used by resolve (and fetch_by_id), which handles each response as soon
+        as it arrives, but it is kept as public API for sending arbitrary requests.
+        """
 
-        return et.tostring(xml_request, encoding="UTF-8", method="xml")
+        max_threads = max_threads or self.max_threads
+        timeout = timeout or self.batch_timeout
+
+        # The pool is closed right away, so that its threads exit once all requests are done,
+        # and unfinished requests do not block anything after a timeout.
+        pool = ThreadPool(max_threads)
+        pending = [pool.apply_async(self.post_with_retries, (data,)) for data in request_data]
+        pool.close()
+
+        deadline = timeout and time.time() + timeout
+        responses = []
+        with self.metrics.timer('lamr.batch.seconds'):
+            for i, result in enumerate(pending):
+                try:
+                    responses.append(result.get(deadline and max(0, deadline - time.time())))
+                except multiprocessing.TimeoutError:
+                    print "Timeout: request %i did not finish in time." % i
+                    self.metrics.count('lamr.request.timeouts')
+                    responses.append(None)
 
-    def requests2responses(self, request_data, max_threads=None):
-        """Throw data at the WOS API in several threads."""
+        return responses
 
-        max_threads = max_threads or self.max_threads
+    def iter_response_papers(self, res):
+        """Parse WOS API output (XML) incrementally, yielding the index and a dict for each paper.
+
+        The papers in the XML response come back in a different order, so each one comes
+        with its name (the index as an integer -- see create_request_data above). Elements
+        are cleared as soon as a paper has been read, so the tree never grows beyond one paper.
+        """
+
+        # The papers are maps at the fourth level (response, fn, outer map, paper map), each
+        # with a map named WOS at the next level that holds the values of the fields.
+        depth = 0
+        fields = {}
+        for event, elem in et.iterparse(StringIO(res.content), events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 3:
+                    outermap = elem
+                continue
+            if depth == 6:
+                fields[elem.get('name')] = elem.text
+            elif depth == 4:
+                yield int(elem.get('name')), fields
+                fields = {}
+                outermap.clear()
+            depth -= 1
 
-        # Each thread will execute this function once, filling up a list of None values,
-        # putting in empty dicts and then response dicts, until there are no more None value.
-        # This simple design allows threads to detect which requests have been sent and
-        # are pending and which have not been sent yet, since the empty dict is assigned
-        # BEFORE a request is sent. In case of ConnectionError (seems to happen sometimes
-        # with many requests) we want to try the request again, so reset corresonding
-        # value to None and continue.
-        responses = [None]*len(request_data)
-        def fetch():
-            while None in responses:
-                i = responses.index(None)
-                responses[i] = {}
-                try:
-                    responses[i] = self.post_request(request_data[i])
-                except requests.ConnectionError:
-                    print "ConnectionError: will retry %i=0 later." %i
-                    responses[i] = None
+    def response2papers(self, res):
+        """Parse WOS API output (XML) into a list of dicts, in the order of the request.
 
-        for i in range(min(max_threads, len(request_data))):
-            threading.Thread(target=fetch).start()
+        This is not used by resolve, which parses responses with iter_response_papers directly,
+        but it is kept as public API for responses from requests2responses.
+        """
 
-        while (None in responses) or ({} in responses):
-            time.sleep(0.50)
+        papers = []
+        with self.metrics.timer('lamr.parse.seconds'):
+            for i, paper in self.iter_response_papers(res):
+                if i >= len(papers):
+                    papers.extend([None] * (i + 1 - len(papers)))
+                papers[i] = paper
 
-        return responses
+        # This is just a sanity check to make sure all indices up to the number
+        # of papers are present in the response.
+        assert None not in papers
 
-    def response2papers(self, res):
-        """Parse WOS API output (XML) into a list of dicts."""
-
-        response = et.fromstring(res.content).getchildren()[0]
-        fn = response.getchildren()[0]
-        outermap = response.getchildren()[0]
-
-        # The papers in the XML response come back in a different order, so we need
-        # to correct that. That is why we first gather all papers into a dict where
-        # the name (index as string -- see create_request_data above) is the key,
-        # and then transform that dict into a list ordered by those indices.
-        papers_dict = {}
-        for paper_map in outermap.getchildren():
-            paper_name = paper_map.attrib['name']
-            papers_dict[paper_name] = {}
-            map_wos = paper_map.getchildren()[0]
-            for field in map_wos.getchildren():
-                papers_dict[paper_name][field.attrib['name']] = field.text
-
-        # This is just a sanity check to make sure all indices up to the cardinality
-        # of the dict are present as string keys.
-        for i in range(len(papers_dict)):
-            assert papers_dict.has_key(str(i))
-
-        return [papers_dict[str(i)] for i in range(len(papers_dict))]
+        return papers
+
+    @staticmethod
+    def normalize_id(type, value):
+        """Normalize an ID for comparisons, where DOIs are case-insensitive."""
+        if not value:
+            return None
+        value = value.strip()
+        return value.lower() if type == 'doi' else value
 
     def fetch_by_id(self, type):
-        """Control fetching from the API by a specific id (UT/PMID/DOI)."""
-
-        # Group all the indices and IDs into chunks that are consistent with request size
-        # limits imposed by the WOS API, and generate the XML data to be sent.
-        indices = chunks(range(self.npapers), self.request_limit)
-        ids = [[self.papers[i][type] for i in ind] for ind in indices]
-        datas = [self.create_request_data(type, v) for v in ids]
-
-        # This is the most time consuming part, still below half a minute for over 2000 articles
-        # when 5 threads are used. Increasing the thread count up to 50 seems to work,
-        # but sometimes produces ConnectionError. So, still make sure to check for that
-        # when sending requests in requests2repsonses for each thread separately.
-        print "Fetching %i papers by %s in %i requests..." %(self.npapers, type.upper(), len(datas))
-        responses = self.requests2responses(datas)
-
-        # The double list comprehension below flattens the papers returned by response2papers
-        # into a single list. Note that keeping the 'No Results Found' condition inside the loop
-        # ensures that the order of articles will be conserved, and those not found will be
-        # returned as None. We want to do some checking on the returned list, here just assert
-        # that the ID used to search each paper is returned with the same value.
-        returned = [p for r in responses for p in self.response2papers(r)]
-        found = [None] * self.npapers
-        for i,p in enumerate(returned):
-            if p.get('message','') != 'No Result Found':
-                found[i] = p
-                assert p[type].lower() == self.papers[i][type].lower()
+        """Control fetching from the API by a specific id (UT/PMID/DOI).
+
+        Each distinct ID is requested only once, however many papers have it, and IDs
+        that are in the cache (if there is one) are not requested at all. The result for
+        each ID is copied to every paper that has it, and papers without IDs are not found.
+        """
+        return self.resolve([type])
+
+    def fetch_ids(self, type, values):
+        """Request papers for a list of IDs of one type, in a single request.
+
+        The request data is created and the response parsed in the calling thread, so in
+        resolve there is never more than one of each per thread in flight. Returns a dict
+        from each normalized ID to the paper found (or None if it was not), or None if the
+        request failed or its response does not have all the papers. This runs in worker
+        threads, so it also catches any other errors, which would otherwise leave the request
+        unfinished.
+        """
+
+        try:
+            response = self.post_with_retries(self.create_request_data(type, values))
+            if response is None:
+                return None
+
+            # Papers are written into the result as they are parsed, by their index in the
+            # request, so the order in the response does not matter. We want to do some checking
+            # on the returned papers, here just assert that the ID used to search each paper
+            # is returned with the same value.
+            keys = [self.normalize_id(type, value) for value in values]
+            fetched = dict.fromkeys(keys)
+            returned = set()
+            with self.metrics.timer('lamr.parse.seconds'):
+                for i, p in self.iter_response_papers(response):
+                    returned.add(i)
+                    if p.get('message','') != 'No Result Found':
+                        fetched[keys[i]] = p
+                        assert self.normalize_id(type, p[type]) == keys[i]
+
+            # Every paper requested should be in the response, even when it is not found, so
+            # anything else (like an error reply) is a failed request, and nothing is cached.
+            if returned != set(range(len(values))):
+                print "Error: response for %i IDs has %i papers." % (len(values), len(returned))
+                self.metrics.count('lamr.request.errors')
+                return None
+            return fetched
+        except Exception as e:
+            print "Error: request for %i IDs failed (%s)." % (len(values), e)
+            return None
+
+    def resolve(self, order=('doi', 'pmid', 'ut'), max_threads=None, timeout=None, table=None):
+        """Find papers by several kinds of IDs, trying each kind in the given order of priority.
+
+        Papers are requested by the first kind of ID, and only those that were not found
+        (or do not have that ID) are requested by the next kind, and so on. The stages are
+        pipelined, so requests for the next kind of ID are sent as soon as there are enough
+        papers for one, while earlier requests are still in flight. Within each stage every
+        distinct ID is requested once, and cached IDs are not requested at all.
+
+        Returns a list with the paper found for each paper (or None, also if its requests
+        failed or did not finish before the timeout for all stages, in seconds). With a table
+        (typically an ArticleTable, see wok_records.py), a row is appended to it for each paper
+        instead, and papers are written into their rows as they are found, without copies.
+
+        The indices of papers that were not found, but whose requests failed or did not finish
+        in some stage (so they might have been found there), are afterwards in self.failed.
+        """
 
-        return found
+        max_threads = max_threads or self.max_threads
+        timeout = timeout or self.batch_timeout
+
+        found = [None] * self.npapers
+        failed = set()
+        if table is not None:
+            first_row = len(table)
+            table.append_empty(self.npapers)
+        stages = [{
+            'type' : type,
+            'waiting' : {},     # indices of papers for each ID that is not resolved yet
+            'values' : {},      # the first value of each ID as given, until it is sent
+            'resolved' : {},    # the paper found for each ID (or None if not found)
+            'buffer' : [],      # IDs that still need to be sent
+            'pending' : 0,      # requests that are in flight
+            'requests' : 0,
+            'closed' : False,   # set when no more papers will come from the stage before
+        } for type in order]
+
+        pool = ThreadPool(max_threads)
+        finished = Queue.Queue()
+
+        def send(istage):
+            stage = stages[istage]
+            keys, stage['buffer'] = stage['buffer'], []
+            stage['pending'] += 1
+            stage['requests'] += 1
+            self.metrics.count('lamr.ids.requested', len(keys))
+            values = [stage['values'].pop(key) for key in keys]
+            pool.apply_async(self.fetch_ids, (stage['type'], values), callback=lambda fetched: finished.put((istage, keys, fetched)))
+
+        # Papers that are not found are collected in a list (passed) and fed to the next stage
+        # all at once, so that their IDs can be looked up in the cache together.
+        def assign(indices, paper, passed):
+            if paper:
+                for i in indices:
+                    if table is not None:
+                        table.update(first_row + i, paper)
+                        found[i] = True
+                    else:
+                        found[i] = dict(paper)
+            else:
+                passed.extend(indices)
+
+        def feed(istage, indices):
+            stage = stages[istage]
+            type = stage['type']
+            keys = [self.normalize_id(type, self.papers[i].get(type)) for i in indices]
+            cached = {}
+            if self.cache:
+                new = set(key for key in keys if key and key not in stage['resolved'] and key not in stage['waiting'])
+                cached = self.cache.get_ids(type, new)
+            passed = []
+            for i, key in zip(indices, keys):
+                if not key:
+                    assign([i], None, passed)
+                elif key in stage['resolved']:
+                    assign([i], stage['resolved'][key], passed)
+                elif key in stage['waiting']:
+                    stage['waiting'][key].append(i)
+                elif key in cached:
+                    self.metrics.count('lamr.ids.cached')
+                    stage['resolved'][key] = cached[key] or None
+                    assign([i], cached[key], passed)
+                else:
+                    stage['waiting'][key] = [i]
+                    stage['values'][key] = self.papers[i][type]
+                    stage['buffer'].append(key)
+                    if len(stage['buffer']) == self.request_limit:
+                        send(istage)
+            forward(istage, passed)
+
+        def forward(istage, passed):
+            if passed and istage+1 < len(stages):
+                feed(istage+1, passed)
+
+        def close(istage):
+            stage = stages[istage]
+            stage['closed'] = True
+            if stage['buffer']:
+                send(istage)
+            if not stage['pending']:
+                print "Requested papers by %s in %i requests, %i papers found so far." % (stage['type'].upper(), stage['requests'], self.npapers - found.count(None))
+                if istage+1 < len(stages):
+                    close(istage+1)
+
+        print "Resolving %i papers by %s..." % (self.npapers, ', then '.join(t.upper() for t in order))
+        started = time.time()
+        feed(0, range(self.npapers))
+        close(0)
+
+        # All the bookkeeping is done here in the main thread, as requests finish one by one,
+        # and the papers not found in each request are fed to the next stage right away.
+        # Papers in failed requests are also passed on, but are not cached.
+        deadline = timeout and time.time() + timeout
+        while any(stage['pending'] for stage in stages):
+            try:
+                istage, keys, fetched = finished.get(True, max(0, deadline - time.time()) if deadline else 1e9)
+            except Queue.Empty:
+                print "Timeout: %i requests did not finish in time." % sum(stage['pending'] for stage in stages)
+                self.metrics.count('lamr.request.timeouts', sum(stage['pending'] for stage in stages))
+                for stage in stages:
+                    for indices in stage['waiting'].values():
+                        failed.update(indices)
+                break
+            stage = stages[istage]
+            stage['pending'] -= 1
+            if fetched is not None:
+                if self.cache:
+                    self.cache.put_ids(stage['type'], fetched)
+                stage['resolved'].update(fetched)
+            passed = []
+            for key in keys:
+                indices = stage['waiting'].pop(key)
+                if fetched is None:
+                    failed.update(indices)
+                assign(indices, fetched and fetched.get(key), passed)
+            forward(istage, passed)
+            if stage['closed'] and not stage['pending']:
+                close(istage)
+
+        pool.close()
+        self.failed = sorted(i for i in failed if found[i] is None)
+        self.metrics.observe('lamr.resolve.seconds', time.time() - started)
+        self.metrics.count('lamr.papers.found', self.npapers - found.count(None))
+        return table if table is not None else found
 
     def fetch_by_pmid(self):
         return self.fetch_by_id('pmid')
 
     def fetch_by_doi(self):
         return self.fetch_by_id('doi')
+
+
+class AdaptiveWebOfScienceAPI(WebOfScienceAPI):
+    """Manage requests to the WoS LAMR API with an adaptive number of requests in flight.
+
+    Instead of a fixed number of threads, which needs to be tuned by hand, there are up to
+    max_threads threads, but requests are only sent while the limiter allows it (see
+    ConcurrencyLimiter), so the API is kept busy without producing ConnectionErrors.
+    A limiter can be shared by several instances that send requests at the same time.
+    """
+
+    max_threads = 50
+
+    def __init__(self, papers, limiter=None, **kwargs):
+        WebOfScienceAPI.__init__(self, papers, **kwargs)
+        self.limiter = limiter or ConcurrencyLimiter(max_limit=self.max_threads)
+
+    def post_request(self, data):
+        # The slot is released whatever happens, since a request that raises anything
+        # (not only a ConnectionError) would otherwise hold it for good.
+        started = self.limiter.acquire()
+        failed = True
+        try:
+            response = WebOfScienceAPI.post_request(self, data)
+            failed = response.status_code != 200
+            return response
+        finally:
+            self.limiter.release(started, failed=failed)
@@ -0,0 +1,139 @@
+import math
+import threading
+import time
+
+
+class Histogram:
+    """Distribution of observed values in logarithmic buckets, with exact count, sum, min and max.
+
+    Each bucket spans a factor of base, so percentiles are estimated within that precision
+    (about 10% by default) for values of any scale, like seconds or bytes, in constant memory.
+    """
+
+    def __init__(self, base=2**0.125):
+        self.base = base
+        self.logbase = math.log(base)
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        key = int(math.floor(math.log(value) / self.logbase)) if value > 0 else None
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Estimate the q-th percentile as the upper bound of its bucket (never more than the maximum)."""
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for key in sorted(self.buckets, key=lambda k: -1e9 if k is None else k):
+            seen += self.buckets[key]
+            if seen >= rank:
+                return min(self.max, 0.0 if key is None else self.base**(key+1))
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count' : self.count,
+            'sum' : self.sum,
+            'min' : self.min,
+            'max' : self.max,
+            'mean' : self.sum / self.count if self.count else None,
+            'p50' : self.percentile(50),
+            'p90' : self.percentile(90),
+            'p99' : self.percentile(99),
+        }
+
+
+class Timer:
+    """Context manager that observes the seconds spent inside it in a histogram of a registry."""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.time() - self.started
+        self.metrics.observe(self.name, self.elapsed)
+
+
+class Metrics:
+    """Thread-safe registry of counters and histograms for instrumenting the clients.
+
+    Names are dotted, starting with the client (search, lamr or soap), and by convention
+    histograms of durations end with .seconds and those of sizes with .bytes. The clients
+    all record into default_metrics unless they are given their own registry.
+
+    Hooks are called with the kind ('count' or 'observe'), name and value of every event
+    as it happens, in the thread that recorded it, for example to trace or export them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.hooks = []
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        for hook in self.hooks:
+            hook('count', name, value)
+
+    def observe(self, name, value):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(value)
+        for hook in self.hooks:
+            hook('observe', name, value)
+
+    def timer(self, name):
+        """Return a context manager that observes how long its block takes, in seconds."""
+        return Timer(self, name)
+
+    def timed(self, name):
+        """Decorate a function so that the duration of each call is observed, in seconds."""
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                with Timer(self, name):
+                    return func(*args, **kwargs)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return decorator
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def snapshot(self):
+        """Return a dict with the current values of all counters and summaries of all histograms."""
+        with self.lock:
+            return {
+                'counters' : dict(self.counters),
+                'histograms' : dict((name, h.snapshot()) for name, h in self.histograms.items()),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+default_metrics = Metrics()
@@ -0,0 +1,242 @@
+import collections
+import csv
+
+from array import array
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Returned by ArticleTable.get_value for fields that a row does not have, since None is a valid value.
+absent = object()
+
+
+class Row(collections.MutableMapping):
+    """A view of one row of an ArticleTable that can be used like the dict it replaces.
+
+    This implements the full mapping protocol, with the same keys and values (including
+    values that are None) as the dict that was added, and assigning to or deleting a key
+    updates the table. Unlike a dict, however, a row cannot be serialized by json.dumps
+    and is not hashable, so use to_dict for a copy that is a plain dict.
+    """
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+        value = self.table.get_value(self.index, key, absent)
+        if value is absent:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.table.set_value(self.index, key, value)
+
+    def __delitem__(self, key):
+        self.table.del_value(self.index, key)
+
+    def __iter__(self):
+        for key, value in self.table.iter_fields(self.index):
+            yield key
+
+    def __len__(self):
+        return sum(1 for item in self.table.iter_fields(self.index))
+
+    def __contains__(self, key):
+        return self.table.get_value(self.index, key, absent) is not absent
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        return self.table.get_value(self.index, key, default)
+
+    def keys(self):
+        return [key for key, value in self.table.iter_fields(self.index)]
+
+    def values(self):
+        return [value for key, value in self.table.iter_fields(self.index)]
+
+    def items(self):
+        return list(self.table.iter_fields(self.index))
+
+    def to_dict(self):
+        return dict(self.table.iter_fields(self.index))
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class ArticleTable:
+    """Columnar storage for articles, which takes a small fraction of the memory of a dict per article.
+
+    Integer fields are kept in arrays of machine integers, and string fields in arrays of
+    indices into a pool of unique values for each column, so repeated values like authors,
+    volumes and years are stored only once. Values of other types than a column expects and
+    fields without a column of their own are kept in a sparse dict for the rows that have them,
+    so nothing is lost. Rows are accessed as Row objects that behave like the original dicts,
+    with the same keys and values, including those that are None.
+
+    Both the scraped article data (see WebOfKnowledgeSearcher.query_into) and LAMR papers
+    (see WebOfScienceAPI.resolve) can be added directly. The LAMR field timesCited is a string,
+    and so it has a column of its own, separate from the times_cited of scraped articles.
+    """
+
+    int_columns = ('year', 'times_cited')
+    str_columns = ('title', 'first_author', 'authors', 'vol', 'pages', 'ut', 'doi', 'pmid', 'timesCited')
+    columns = ('title', 'first_author', 'vol', 'pages', 'year', 'times_cited', 'authors', 'ut', 'doi', 'pmid', 'timesCited')
+
+    # Missing values in the arrays of integers and string indices, and None in the arrays of integers.
+    missing = -2**31
+    null = -2**31 + 1
+
+    def __init__(self, records=()):
+        self.nrows = 0
+        self.arrays = dict((name, array('i')) for name in self.int_columns + self.str_columns)
+        self.pools = dict((name, []) for name in self.str_columns)
+        self.pool_index = dict((name, {}) for name in self.str_columns)
+        self.extras = {}
+        self.extend(records)
+
+    def __len__(self):
+        return self.nrows
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [Row(self, i) for i in range(*index.indices(self.nrows))]
+        if index < 0:
+            index += self.nrows
+        if not 0 <= index < self.nrows:
+            raise IndexError("row index out of range")
+        return Row(self, index)
+
+    def __iter__(self):
+        for index in xrange(self.nrows):
+            yield Row(self, index)
+
+    def append_empty(self, nrows=1):
+        """Add rows without any fields, which can be filled later with update."""
+        empty = array('i', [self.missing]) * nrows
+        for values in self.arrays.values():
+            values.extend(empty)
+        self.nrows += nrows
+
+    def append(self, record):
+        """Add a row with the fields of a dict (or Row), or an empty row for None."""
+        self.append_empty()
+        if record:
+            self.update(self.nrows - 1, record)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def update(self, index, record):
+        for key, value in record.items():
+            self.set_value(index, key, value)
+
+    def set_value(self, index, key, value):
+        """Set the value of a field in a row, where None is kept as a value like any other."""
+
+        if key in self.pools:
+            # Values are pooled by type, too, so that for example str and unicode stay apart.
+            if value is None or isinstance(value, basestring):
+                pool_index = self.pool_index[key]
+                pooled = (type(value), value)
+                if pooled not in pool_index:
+                    pool_index[pooled] = len(self.pools[key])
+                    self.pools[key].append(value)
+                self.arrays[key][index] = pool_index[pooled]
+                self._drop_extra(index, key)
+                return
+        elif key in self.arrays:
+            if value is None:
+                self.arrays[key][index] = self.null
+                self._drop_extra(index, key)
+                return
+            if type(value) in (int, long) and self.null < value < 2**31:
+                self.arrays[key][index] = value
+                self._drop_extra(index, key)
+                return
+        if key in self.arrays:
+            self.arrays[key][index] = self.missing
+        self.extras.setdefault(index, {})[key] = value
+
+    def del_value(self, index, key):
+        """Remove a field from a row, raising a KeyError if the row does not have it."""
+        if key in self.arrays and self.arrays[key][index] != self.missing:
+            self.arrays[key][index] = self.missing
+        elif key in self.extras.get(index, {}):
+            self._drop_extra(index, key)
+        else:
+            raise KeyError(key)
+
+    def _drop_extra(self, index, key):
+        extras = self.extras.get(index)
+        if extras and key in extras:
+            del extras[key]
+            if not extras:
+                del self.extras[index]
+
+    def get_value(self, index, key, default=None):
+        """Return the value of a field in a row, or the default if the row does not have it."""
+        if key in self.arrays:
+            value = self.arrays[key][index]
+            if value != self.missing:
+                if key in self.pools:
+                    return self.pools[key][value]
+                return None if value == self.null else value
+        return self.extras.get(index, {}).get(key, default)
+
+    def iter_fields(self, index):
+        for key in self.columns:
+            value = self.get_value(index, key, absent)
+            if value is not absent:
+                yield key, value
+        for item in self.extras.get(index, {}).items():
+            if item[0] not in self.arrays:
+                yield item
+
+    def column(self, key):
+        """Return a list with the values of a field in all rows (None where it is missing)."""
+        return [self.get_value(index, key) for index in xrange(self.nrows)]
+
+    def to_csv(self, f, columns=None):
+        """Write the rows to a CSV file (a path or file object) with a header, encoding strings as UTF-8."""
+
+        columns = columns or self.columns
+        if isinstance(f, basestring):
+            with open(f, 'wb') as f:
+                return self.to_csv(f, columns)
+
+        encode = lambda value: value.encode('utf-8') if isinstance(value, unicode) else value
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        data = [self.column(key) for key in columns]
+        for row in izip(*data):
+            writer.writerow([encode(value) if value is not None else '' for value in row])
+
+    def to_numpy(self, columns=None):
+        """Return a dict with a NumPy array for each column.
+
+        Integer fields become float arrays with NaN where values are missing, None or not integers,
+        and string fields object arrays with None. This needs NumPy, which is otherwise not required.
+        """
+
+        if numpy is None:
+            raise ImportError("NumPy is needed to export an ArticleTable to arrays")
+
+        arrays = {}
+        for key in columns or self.columns:
+            if key in self.int_columns:
+                values = numpy.array(self.arrays[key], dtype=float)
+                values[(values == self.missing) | (values == self.null)] = numpy.nan
+            else:
+                values = numpy.array(self.column(key), dtype=object)
+            arrays[key] = values
+        return arrays
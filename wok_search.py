@@ -1,15 +1,30 @@
-import cookielib
-import errno
-import random
+import Queue
+import multiprocessing
 import re
-import socket
 import sys
+import threading
 import time
 import urllib
-import urllib2
+
+import requests
+
+from multiprocessing.pool import ThreadPool
 
 from BeautifulSoup import BeautifulSoup
 
+from wok_html import StreamBackend
+from wok_http import default_transport
+from wok_metrics import default_metrics
+from wok_throttle import RandomJitterThrottle
+
+
+def parse_page(parser, response):
+    """Parse the data for all articles in a page of search results.
+
+    This is a plain function, so that it can also be run in another process.
+    """
+    return [WebOfKnowledgeSearcher.parse_article_data(res) for res in parser.parse(response)[1]]
+
 
 class WebOfKnowledgeSearcher:
     """Automate the task of searching WoK for papers."""
@@ -18,7 +33,26 @@ class WebOfKnowledgeSearcher:
     searchurl = "http://apps.webofknowledge.com/UA_GeneralSearch.do"
     summaryurl = "http://apps.webofknowledge.com/summary.do"
 
+    # The session cookie is looked for in this domain.
+    cookie_domain = '.webofknowledge.com'
+
     uagent = 'Mozilla/4.0 (compatible; MSIE 7.0; Windows NT 5.1; Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1) ; .NET CLR 2. '
+    # Queries with more pages than this return only the first page, since the results
+    # are usually not useful anyway (very popular author names or very short titles).
+    max_pages = 10
+
+    # The message in the page returned for a query without any results.
+    no_records = "Your search found no records"
+
+    # The most values that are stacked with OR statements into a single query.
+    max_batch_size = 50
+
+    # Queries for a batch of values that fail are retried this many times (see _split_query).
+    batch_retries = 1
+
+    # The most authors listed for each search result, so with this many the list may be truncated.
+    listed_authors = 3
+
     static_query_data = {
         'product' : 'UA',
         'parentProduct' : 'UA',
@@ -27,7 +61,7 @@ class WebOfKnowledgeSearcher:
         'range' : 'ALL'
     }
 
-    def __init__(self, logfunc=None):
+    def __init__(self, logfunc=None, cache=None, page_workers=1, warm_standby=True, throttle=None, parser=None, parse_pool=None, transport=None, metrics=None):
 
         # Only a certain number of queries are allowed per session, and there is typically
         # one POST request per query, followed by one or more additional GET request(s),
@@ -39,6 +73,55 @@ class WebOfKnowledgeSearcher:
         self.query_count = 0
         self.post_request_count = 0
         self.get_request_count = 0
+        self.counter_lock = threading.Lock()
+
+        # Each session has its own cookies, but connections are kept alive and shared
+        # with other clients using the same transport (see wok_http.py).
+        self.transport = transport or default_transport
+
+        # An optional QueryCache (see wok_cache.py), which makes repeated queries cost
+        # no requests at all and does not count against the query budget of the session.
+        self.cache = cache
+
+        # The number of values and results seen in queries for each field, for batching
+        # values into queries that do not have too many results (see estimate_batch_size).
+        self.results_per_value = {}
+
+        # The throttle paces queries and session resets (see wok_throttle.py), and is told
+        # about failures and healthy responses so that it can adapt. The default keeps the
+        # random delays used before there were throttles.
+        self.throttle = throttle or RandomJitterThrottle()
+
+        # The parser backend extracts the pagecount and search result items from each page
+        # in one go (see wok_html.py). The default StreamBackend is much faster than parsing
+        # with BeautifulSoup, which is still available as SoupBackend for reference.
+        self.parser = parser or StreamBackend()
+
+        # Parsing holds the GIL, so pages after the first one can instead be parsed in a pool
+        # of processes (a multiprocessing.Pool, which can be shared by several searchers),
+        # while further pages are still being fetched.
+        self.parse_pool = parse_pool
+
+        # Once the query ID and pagecount are known, all remaining pages can be fetched
+        # concurrently within the same session, using this many worker threads. The default
+        # of one worker fetches the pages one after another, as has always been the case.
+        self.page_workers = page_workers
+        self.page_pool = None
+
+        # The next session can be created in the background a few queries before the reset
+        # is due (warm_ahead), so that the query path does not stall on the reset. The ready
+        # and miss counts record how often the standby session was or was not ready in time.
+        self.warm_standby = warm_standby
+        self.warm_ahead = 5
+        self.standby = None
+        self.standby_session = None
+        self.warm_ready_count = 0
+        self.warm_miss_count = 0
+
+        # Latencies, sizes, parse times, session resets and throttling are recorded here
+        # (see wok_metrics.py), with names starting with 'search.'. Pages parsed in a parse
+        # pool are only timed as a whole, in the search.parse.pool.seconds histogram.
+        self.metrics = metrics or default_metrics
 
         # Note that this is a function that logs a message, not a logger object.
         logfunc = logfunc or (lambda msg: sys.stdout.write("%s\n" %msg))
@@ -51,68 +134,126 @@ class WebOfKnowledgeSearcher:
         self.log = lambda msg: logfunc("Query %i - %s" % (self.query_count, msg))
         self.logger = self.log
 
-    def _request(self, url, data=None):
+    def _request(self, url, data=None, session=None):
         """Basic logic for making requests.
 
         Passing data to the request effectively makes it a POST request,
         otherwise it is a GET request (the URL may still contain encoded data).
+        The request goes through the current session, unless another session
+        is passed (for example, when creating a new session).
         """
 
-        if data:
-            self.post_request_count += 1
-            request = urllib2.Request(url, urllib.urlencode(data), headers={'User-agent' : self.uagent})
-        else:
-            self.get_request_count += 1
-            request = urllib2.Request(url, headers={'User-agent' : self.uagent})
-
-        if not request:
-            self.log("Unable to connect to %s" % url)
-            return -1
-
+        session = session or self.session
+        started = time.time()
         try:
-            return self.opener.open(request).read()
-        except urllib2.URLError as e:
+            if data:
+                with self.counter_lock:
+                    self.post_request_count += 1
+                response = session.post(url, data=data)
+            else:
+                with self.counter_lock:
+                    self.get_request_count += 1
+                response = session.get(url)
+        except requests.RequestException as e:
             self.log("Request error: %s" % e)
+            self.metrics.count('search.request.errors')
+            self.throttle.failure()
             return -1
-        except socket.error as serr:
-            if serr.errno != errno.ECONNREFUSED:
-                raise serror
-            self.log("Socket error: %s" % serr)
+
+        self.metrics.observe('search.request.seconds', time.time() - started)
+        self.metrics.observe('search.request.bytes', len(response.content))
+
+        if response.status_code >= 400:
+            self.log("Request error: HTTP %i for %s" % (response.status_code, url))
+            self.metrics.count('search.request.errors')
+            self.throttle.failure()
             return -1
 
-    def _create_session(self):
-        """Create a cookie and session, and get the session ID."""
+        return response.content
 
-        self.cookie_jar = cookielib.CookieJar() 
-        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(self.cookie_jar))
-        urllib2.install_opener(self.opener)
+    def _new_session(self):
+        """Create a session with its own cookies, and get a new session ID.
 
-        response = self._request(self.wokurl)
-        try:
-            self.SID = self.cookie_jar._cookies['.webofknowledge.com']['/']['SID'].value
-        except KeyError as e:
-            self.log("Unable to retrieve session ID from WoK (KeyError: %s)" % e)
+        This does not touch the current session, and returns a 2-tuple with the session
+        and the session ID, which is None if it could not be retrieved.
+        """
+
+        session = self.transport.session(headers={'User-agent' : self.uagent})
+
+        response = self._request(self.wokurl, session=session)
+        SID = session.cookies.get('SID', domain=self.cookie_domain, path='/')
+        if not SID:
+            self.log("Unable to retrieve session ID from WoK")
+
+        return session, SID
+
+    def _create_session(self, session=None):
+        """Switch to a new session, creating one unless it is passed."""
+
+        self.session, SID = session or self._new_session()
+        if not SID:
             return -1
 
+        self.SID = SID
         self.session_count += 1
+        self.metrics.count('search.sessions')
+
+    def _warm_session(self):
+        """Create the next session in a background thread, without any effect on the current one."""
+
+        def create():
+            with self.metrics.timer('search.throttle.seconds'):
+                self.throttle.wait_reset()
+            self.standby_session = self._new_session()
+
+        self.standby_session = None
+        self.standby = threading.Thread(target=create)
+        self.standby.daemon = True
+        self.standby.start()
 
     def _prepare_session(self):
         """This should be called at least before each new query.
 
-        Interpose some random delays, and make sure to reset the session
-        after a certain amount of queryies.
+        Interpose delays according to the throttle, and make sure to reset the session
+        after a certain amount of queryies. With a warm standby, the next session
+        is created in the background as the reset approaches, and the reset itself
+        only switches to it (or waits for it if it is not ready yet).
         """
 
-        if random.random() > 0.75:
-            time.sleep(0.5*random.random())
+        with self.metrics.timer('search.throttle.seconds'):
+            self.throttle.wait()
+
+        queries_left = self.query_reset - self.query_count % self.query_reset
+        if self.warm_standby and not self.standby and queries_left <= self.warm_ahead:
+            self._warm_session()
 
         if (self.query_count > 0) and (self.query_count % self.query_reset == 0):
             self.log("Resetting connection with ISI Web of Knowledge.")
-            self.opener.close()
-            self.cookie_jar.clear_session_cookies()
-            time.sleep(0.5 + 5.0*random.random())
+            self.metrics.count('search.session.resets')
+            self.session.cookies.clear_session_cookies()
+            if self.standby:
+                if self.standby.is_alive():
+                    self.warm_miss_count += 1
+                    self.metrics.count('search.session.warm_misses')
+                    with self.metrics.timer('search.session.wait.seconds'):
+                        self.standby.join()
+                else:
+                    self.warm_ready_count += 1
+                    self.metrics.count('search.session.warm_ready')
+                session, self.standby = self.standby_session, None
+                if session and session[1]:
+                    self._create_session(session)
+                    return
+                # The server is probably misbehaving if the standby session is not valid,
+                # so wait for the reset delay before creating another one, as without a standby.
+                self.log("Standby session is not valid, creating a new one.")
+            with self.metrics.timer('search.throttle.seconds'):
+                self.throttle.wait_reset()
             self._create_session()
 
+    # These use BeautifulSoup directly and are not used by queries anymore, which instead
+    # parse each response only once with self.parser, but are kept for convenience.
+
     # This return a list of pagecounts in the response, and there should normally be just one.
     find_pagecounts = lambda self, resp: BeautifulSoup(resp).findAll("span", { "id" : "pageCount.top" })
 
@@ -124,38 +265,115 @@ class WebOfKnowledgeSearcher:
 
         The general procedure is to POST a query to the server, and then subsequently use
         the current session and query IDs to increase the page size and iterate through
-        all the pages in the result list.
+        all the pages in the result list (see _query_pages, which does all the work).
 
         Should always return a 2-tuple, which on success contains a list of parsed data
         for each article in the result list and the total pagecount. When an error is encountered,
         typically return a negative integer as the first value of the tuple.
         """
 
+        article_data, npages = [], 0
+        with self.metrics.timer('search.query.seconds'):
+            for ipage, pagecount, articles in self._query_pages(data, pagesize):
+                if ipage == -1:
+                    self.metrics.count('search.query.errors')
+                    return -1, 0
+                article_data += articles
+                npages = ipage
+
+        self.metrics.observe('search.query.pages', npages)
+        return article_data, npages
+
+    def iter_query(self, data, pagesize=50):
+        """Generate parsed data for each article in the result list of a query, as pages arrive.
+
+        This works just like _generic_query, except that the articles in each page can be
+        processed as soon as it is parsed, and the result list is never kept in memory.
+        Since the generator cannot return anything else, the pagecount that _generic_query
+        would have returned is stored in self.last_pagecount, or -1 in case of an error.
+        """
+
+        self.last_pagecount = 0
+        for ipage, pagecount, articles in self._query_pages(data, pagesize):
+            if ipage == -1:
+                self.last_pagecount = -1
+                return
+            self.last_pagecount = ipage
+            for article in articles:
+                yield article
+
+    def query_into(self, table, data, pagesize=50):
+        """Append the articles in the result list of a query to a table, as pages arrive.
+
+        The table is typically an ArticleTable (see wok_records.py), which stores the articles
+        much more compactly than the dicts that are otherwise returned, so only the articles
+        in one page are ever kept as dicts. Returns the pagecount like iter_query.
+        """
+        for article in self.iter_query(data, pagesize):
+            table.append(article)
+        return self.last_pagecount
+
+    def _query_pages(self, data, pagesize=50):
+        """Generate the pages in the result list of a query, one by one.
+
+        Each page is generated as a 3-tuple with the page number, the total pagecount and
+        a list of parsed data for each article in the page. If there is an error before the
+        first page, a single tuple with a page number of -1 is generated, but in some cases
+        (for example, when there are no results) nothing is generated at all. If any later
+        page cannot be fetched, all pages before it will still have been generated.
+
+        If there is a cache, results for queries that have been seen before are taken from it.
+        Only definite outcomes are stored there, namely complete result lists and responses
+        with no results -- errors and partial results are never cached.
+        """
+
+        if self.cache:
+            cached = self.cache.get_query(data)
+            if cached is not None:
+                self.log("Using cached results for query.")
+                self.metrics.count('search.cache.hits')
+                article_data, pagecount = cached
+                if pagecount:
+                    yield (1 if pagecount > self.max_pages else pagecount), pagecount, article_data
+                return
+
         self.query_count += 1
+        self.metrics.count('search.queries')
 
         self._prepare_session()
 
         # This is the initial POST request.
         response = self._request(self.searchurl, data=data)
         if response == -1:
-            return -1,0
+            yield -1, 0, None
+            return
 
         # If there pagecount length is not one, there were probably no results, and we need to bail out.
         # Also, getting the actual integer sometimes for pagecount sometimes fails when the formatting
         # of HTML is mangled so we want to return nothing in that case, too. It might be a better option,
-        # however, to retry the request in such a case.
-        pagecount = self.find_pagecounts(response)
+        # however, to retry the request in such a case. Only pages that say there are no records
+        # are cached, since others (for example for an expired session) would hide real results.
+        pagecount, results = self._parse(response)
         try:
             assert len(pagecount) == 1
             pagecount = int(pagecount[0].text)
         except AssertionError:
+            if self.no_records not in response:
+                self.log("No pagecount and no message about no records, something is wrong.")
+                self.log("Request data: " + str(data))
+                self.throttle.failure()
+                yield -1, 0, None
+                return
             self.log("Length of pagecount was not one, quitting query.")
             self.log("Request data: " + str(data))
-            return [], 0
+            if self.cache:
+                self.cache.put_query(data, [], 0)
+            return
         except ValueError:
             self.log("Could not convert pagecount to integer, quitting query.")
             self.log("Request data: " + str(data))
-            return [], 0
+            self.throttle.failure()
+            return
 
         # Sometimes the query ID is not incremented (for example for error repsonses). Instead of discovering
         # all the various conditions, parse the response for the current query ID and use that.
@@ -164,68 +382,301 @@ class WebOfKnowledgeSearcher:
         if len(qids) != 1:
             self.log("Unable to parse a consistent query ID, something is wrong.")
             self.log("Request data: " + str(data))
-            return -1, 0
+            self.throttle.failure()
+            yield -1, 0, None
+            return
         qid = qids[0]
+        self.throttle.success()
 
         # Now change the page size if needed.
         if pagecount > 1:
-            data = self.static_query_data.copy()
-            data['qid'] = qid
-            data['SID'] = self.SID
-            data['action'] = 'changePageSize'
-            data['pageSize'] = pagesize
-            response = self._request(self.summaryurl + "?" + urllib.urlencode(data))
+            pagedata = self.static_query_data.copy()
+            pagedata['qid'] = qid
+            pagedata['SID'] = self.SID
+            pagedata['action'] = 'changePageSize'
+            pagedata['pageSize'] = pagesize
+            response = self._request(self.summaryurl + "?" + urllib.urlencode(pagedata))
             if response == -1:
-                return -1,0
-            pagecount = self.find_pagecounts(response)
+                yield -1, 0, None
+                return
+            pagecount, results = self._parse(response)
             try:
                 assert len(pagecount) == 1
                 pagecount = int(pagecount[0].text)
             except AssertionError:
-                return [], 0
+                return
 
-        # Gather all the parsed data from the first page.
-        article_data = [self.parse_article_data(res) for res in self.find_results(response)]
+        # Gather all the parsed data from the first page. All articles are also kept
+        # in a separate list, but only when they will be cached at the end.
+        article_data = self._parse_articles(results)
+        cached = article_data[:] if self.cache else None
 
         # This happens when the author names are popular or the title is very short.
-        if pagecount > 10:
+        # The full pagecount is cached in this case, so that it is clear the results are truncated.
+        if pagecount > self.max_pages:
             self.log("Too many pages (%i) in response, using only first one." % pagecount)
-            return article_data, 1
+            yield 1, pagecount, article_data
+            if self.cache:
+                self.cache.put_query(data, cached, pagecount)
+            return
+
+        yield 1, pagecount, article_data
+
+        # Finally, iterate over all pages if there are more. In case of any problems,
+        # the pages before that one have been generated already (up to ipage-1).
+        npages = 1
+        for ipage, article_data in self._parse_pages(self._fetch_pages(qid, range(2, pagecount+1)), 2):
+            if self.cache:
+                cached += article_data
+            npages = ipage
+            yield ipage, pagecount, article_data
+
+        if self.cache and npages == pagecount:
+            self.cache.put_query(data, cached, pagecount)
+
+    def _parse_pages(self, responses, first):
+        """Generate the page number and parsed article data for responses, in order.
+
+        This stops at the first failed response. With a parse pool, pages are parsed in the
+        background, and each is generated once it and all pages before it have been parsed,
+        so that the next pages are fetched in the meantime.
+        """
 
-        # Finally, iterate over all pages if there are more. In case of any problems, we can
-        # try to return the data we have collected hitherto (up to ipage-1).
-        if pagecount > 1:
-            for ipage in range(2,pagecount+1):
+        pending = []
+        for ipage, response in enumerate(responses, first):
+            if response == -1:
+                break
+            if not self.parse_pool:
+                yield ipage, self._parse_articles(self._parse(response)[1])
+                continue
+            pending.append((ipage, time.time(), self.parse_pool.apply_async(parse_page, (self.parser, response))))
+            while pending and pending[0][2].ready():
+                ipage, started, result = pending.pop(0)
+                self.metrics.observe('search.parse.pool.seconds', time.time() - started)
+                yield ipage, result.get()
+
+        for ipage, started, result in pending:
+            article_data = result.get()
+            self.metrics.observe('search.parse.pool.seconds', time.time() - started)
+            yield ipage, article_data
+
+    def _parse(self, response):
+        """Return the pagecount elements and search result items in a page, timing the parser."""
+        with self.metrics.timer('search.parse.page.seconds'):
+            return self.parser.parse(response)
+
+    def _parse_articles(self, results):
+        """Parse the data for each search result item, timing each one."""
+        article_data = []
+        for res in results:
+            with self.metrics.timer('search.parse.record.seconds'):
+                article_data.append(self.parse_article_data(res))
+        return article_data
+
+    def _fetch_pages(self, qid, pages):
+        """Generate responses for the given pages of a query result list, in page order.
+
+        With more than one page worker, all pages are requested concurrently through a pool
+        of threads that share the session (and cookies), but responses are still generated
+        in order as soon as they are available. Otherwise, each page is requested only when
+        the previous one was consumed, so nothing more is requested after a failure.
+        """
+
+        urls = []
+        for ipage in pages:
+            pagedata = self.static_query_data.copy()
+            pagedata['qid'] = qid
+            pagedata['SID'] = self.SID
+            pagedata['page'] = ipage
+            urls.append(self.summaryurl + "?" + urllib.urlencode(pagedata))
+
+        if self.page_workers > 1 and len(urls) > 1:
+            self.log("Fetching additional pages %i-%i concurrently..." % (pages[0], pages[-1]))
+            if not self.page_pool:
+                self.page_pool = ThreadPool(self.page_workers)
+            for response in self.page_pool.imap(self._request, urls):
+                yield response
+        else:
+            for ipage, url in zip(pages, urls):
                 self.log("Fetching additional page %i..." % ipage)
-                data = self.static_query_data.copy()
-                data['qid'] = qid
-                data['SID'] = self.SID
-                data['page'] = ipage
-                response = self._request(self.summaryurl + "?" + urllib.urlencode(data))
-                if response == -1:
-                    return article_data, ipage-1
-                article_data += [self.parse_article_data(res) for res in self.find_results(response)]
+                yield self._request(url)
 
-        return article_data, pagecount
+    def close(self):
+        """Close the pool of page workers, if any were started. The searcher can still be used afterwards."""
+        if self.page_pool:
+            self.page_pool.close()
+            self.page_pool = None
 
     query_for_title = lambda self, papers: self.query_for_field(papers, 'title', 'TI')
     query_for_doi   = lambda self, papers: self.query_for_field(papers, 'doi', 'DO')
-    def query_for_field(self, papers, name_local, name_wok):
+    def query_for_field(self, papers, name_local, name_wok, batch_size=None):
         """Perform a query for a single field, for several articles by stacking OR statements.
 
         Argument papers is the list of papers to search for, whereas name_local
         is the dictionary key of the field to use, and name_wok is the two-letter
         WoK code for that ID (for example, for title it is 'TI').
+
+        Papers are stacked into batches that should have few enough results to fit into
+        the pages that are fetched, and the results of all batches are merged (see _split_query).
+        The batch size is estimated from earlier queries for the same field, unless it is passed.
+        Values in batches that failed are afterwards in self.failed_batches.
         """
-        pairs = [(name_wok, p[name_local]) for p in papers if p[name_local]]
-        data = self.create_query_data(pairs, operator="OR")
-        return self._generic_query(data)
+        values = [p[name_local] for p in papers if p[name_local]]
+        create = lambda batch: self.create_query_data([(name_wok, v) for v in batch], operator="OR")
+        return self._split_query(values, create, name_wok, batch_size or self.estimate_batch_size(name_wok))
+
+    def estimate_batch_size(self, key, pagesize=50):
+        """Estimate how many values can be stacked in one query without too many pages.
+
+        This uses the average number of results per value in earlier queries with the same key,
+        and aims for half of the results that fit into the pages that are fetched, since
+        the number of results per value varies a lot. Before there are any queries,
+        it assumes there is one result per value.
+        """
+        nvalues, nresults = self.results_per_value.get(key, (1, 1))
+        capacity = 0.5 * self.max_pages * pagesize
+        return max(1, min(self.max_batch_size, int(capacity * nvalues / max(nresults, 1))))
+
+    def _split_query(self, values, create, key, batch_size):
+        """Query for values in batches, splitting batches in half when there are too many pages.
+
+        Argument create is a function that returns the query data for a list of values,
+        and key identifies the kind of values for estimating batch sizes. Batches that still
+        have too many pages are split recursively, so that no results are lost. The results
+        of all queries are merged and duplicates are removed.
+
+        A query that fails, or stops before the last page, is retried up to batch_retries times.
+        If it still fails, its batch is added to self.failed_batches, and the results of all
+        other batches are kept, so the results for values in failed batches are missing.
+
+        This returns a 2-tuple like _generic_query, with the total number of pages fetched
+        as the second value, or (-1, 0) if all of the queries fail.
+        """
+
+        self.failed_batches = []
+        article_data, npages, seen = [], 0, set()
+        batches = [values[i:i+batch_size] for i in range(0, len(values), batch_size)]
+        nqueried = 0
+        while batches:
+            batch = batches.pop(0)
+            for attempt in range(self.batch_retries + 1):
+                pages = list(self._query_pages(create(batch)))
+                if not pages or pages[0][1] > self.max_pages or pages[-1][0] == pages[0][1]:
+                    break
+                self.log("Query for %i values failed (attempt %i)." % (len(batch), attempt + 1))
+            else:
+                self.failed_batches.append(batch)
+                continue
+            nqueried += 1
+
+            # The first page of a truncated result list is merged, too, since those results
+            # are valid anyway, but all of them should come back from the two halves.
+            pagecount = pages[0][1] if pages else 0
+            if pagecount > self.max_pages and len(batch) > 1:
+                self.log("Too many pages (%i) for %i values, splitting query in two." % (pagecount, len(batch)))
+                half = len(batch) // 2
+                batches[:0] = [batch[:half], batch[half:]]
+            elif pagecount <= self.max_pages:
+                nvalues, nresults = self.results_per_value.get(key, (0, 0))
+                self.results_per_value[key] = (nvalues + len(batch), nresults + sum(len(p[2]) for p in pages))
+
+            for page in pages:
+                npages += 1
+                for article in page[2]:
+                    signature = tuple(sorted(article.items()))
+                    if signature not in seen:
+                        seen.add(signature)
+                        article_data.append(article)
+
+        if self.failed_batches and not nqueried:
+            return -1, 0
+        return article_data, npages
 
     def query_for_author_pair(self, author1, author2):
         """Perform a query for articles that contain two authors."""
         data = self.create_query_data([('AU', author1), ('AU', author2)])
         return self._generic_query(data)
 
+    def query_for_author_pairs(self, pairs, batch_size=None):
+        """Perform queries for articles that contain two authors, for many pairs at once.
+
+        Batches of pairs are combined into single queries like (AU=a AND AU=b) OR (AU=c AND AU=d),
+        which works since AND takes precedence over OR, and batches with too many results are
+        split (see _split_query). The results are then assigned back to each pair using the
+        authors listed for each article (see match_author), and an article is only assigned
+        to the pairs with both authors listed. Only up to three authors are listed, however,
+        so when an article matches no pair completely, all pairs in the batch are queried again
+        separately, except those ruled out by a complete list without any of their authors.
+        When the list may be truncated, pairs with only one author listed are queried again
+        even if another pair matches completely, since the other author may be missing.
+
+        Returns a list with a 2-tuple for each pair, like that returned by query_for_author_pair,
+        except the second value is the number of pages fetched for the batch of that pair.
+        Pairs in batches that failed (see _split_query) get (-1, 0), as if their query failed.
+        """
+
+        batch_size = batch_size or min(self.estimate_batch_size('AU pairs'), self.max_batch_size // 2)
+
+        def create(batch):
+            fields = [('AU', author) for pair in batch for author in pair]
+            operators = ['AND', 'OR'] * len(batch)
+            return self.create_query_data(fields, operator=operators[:len(fields)-1])
+
+        results = []
+        for i in range(0, len(pairs), batch_size):
+            batch = pairs[i:i+batch_size]
+            article_data, npages = self._split_query(batch, create, 'AU pairs', len(batch))
+            if article_data == -1:
+                results += [(-1, 0)] * len(batch)
+                continue
+            failed = set(ip for ip, pair in enumerate(batch) if any(pair in b for b in self.failed_batches))
+
+            assigned = [[] for pair in batch]
+            ambiguous = set()
+            for article in article_data:
+                authors = [author for author in article.get('authors', '').split('; ') if author]
+                complete = 0 < len(authors) < self.listed_authors
+                matches = [[any(self.match_author(a, author) for author in authors) for a in pair] for pair in batch]
+                full = [ip for ip, m in enumerate(matches) if all(m)]
+                if full:
+                    for ip in full:
+                        assigned[ip].append(article)
+                    if not complete:
+                        ambiguous.update(ip for ip, m in enumerate(matches) if any(m) and not all(m))
+                    continue
+
+                # Any author of a pair may be missing from a truncated list, so a pair can only be
+                # ruled out when the list is complete and none of its authors are in it. If that rules
+                # out all of them, the names just did not match, so query all pairs to be safe.
+                possible = [ip for ip, m in enumerate(matches) if any(m) or not complete]
+                ambiguous.update(possible or range(len(batch)))
+
+            ambiguous -= failed
+            if ambiguous:
+                self.log("Querying %i author pairs separately, since some results are ambiguous." % len(ambiguous))
+            for ip in range(len(batch)):
+                if ip in failed:
+                    results.append((-1, 0))
+                elif ip in ambiguous:
+                    results.append(self.query_for_author_pair(*batch[ip]))
+                else:
+                    results.append((assigned[ip], npages))
+
+        return results
+
+    @staticmethod
+    def match_author(name, author):
+        """Check whether an author listed in the results (like 'Einstein, A') matches a name used in a query.
+
+        The last names must be equal, and initials are compared only when the name has any,
+        in which case they must be the first initials of the author. Wildcards are ignored.
+        """
+        name = name.lower().replace('*', '').replace(',', ' ').split()
+        author = author.lower().replace(',', ' ').split()
+        if not name or not author or name[0] != author[0]:
+            return False
+        return ''.join(author[1:]).startswith(''.join(name[1:]))
+
     def create_query_data(self, fields, operator="AND"):
         """Create query data for POST request from fields dict, glued with and operator."""
 
@@ -243,7 +694,8 @@ class WebOfKnowledgeSearcher:
 
         return data
 
-    def parse_article_data(self, soup):
+    @staticmethod
+    def parse_article_data(soup):
         """Extract data about an article from the search results HTML fragment for that article."""
 
         parsed = {}
@@ -258,22 +710,26 @@ class WebOfKnowledgeSearcher:
 
         # The first author, volume, pages and year should all occur after a <span> element
         # with an appropriate text. The DOI also used to be parsable in this way, before V5.13.
-        for i,span in enumerate(soup.findAll("span")):
+        # Find all the <span> elements only once, since the data is in the one after the trigger.
+        spans = soup.findAll("span")
+        for i,span in enumerate(spans):
 
             # Up to three authors are listed in a <div> element directly after a <span> element
-            # with the appropriate trigger text.
+            # with the appropriate trigger text. All the listed authors are also kept, separated
+            # by semicolons, which is needed to tell apart results of batched author queries.
             if span.text[:3] == "By:":
                 try:
                     parsed['first_author'] = span.parent.text.replace("By:", "").split(";")[0]
+                    parsed['authors'] = u'; '.join(a.strip() for a in span.parent.text.replace("By:", "").split(";"))
                 except IndexError:
-                    parsed = filter_out(parser, 'first_author')
+                    parsed = filter_out(parsed, 'first_author')
 
             # The voume is found in the next <span> element after the <span> element with the
             # appropriate trigger text. Sometimes the volumes contains the issue, too, for example
             # when it is a supplement (as in '18 Suppl 1'), in which case remove it.
             if span.text[:7] == "Volume:":
                 try:
-                    parsed['vol'] = soup.findAll("span")[i+1].text.lower()
+                    parsed['vol'] = spans[i+1].text.lower()
                     if "suppl" in parsed['vol']:
                         parsed['vol'] = parsed['vol'].split('suppl')[0].strip()
                 except IndexError:
@@ -284,12 +740,12 @@ class WebOfKnowledgeSearcher:
             # so we need to parse that separately.
             if span.text[:6] == "Pages:":
                 try:
-                    parsed['pages'] = soup.findAll("span")[i+1].text
+                    parsed['pages'] = spans[i+1].text
                 except IndexError:
                     parsed = filter_out(parsed, 'pages')
             if span.text[:15] == "Article Number:":
                 try:
-                    parsed['article number'] = soup.findAll("span")[i+1].text
+                    parsed['article number'] = spans[i+1].text
                 except IndexError:
                     parsed = filter_out(parsed, 'article number')
 
@@ -300,11 +756,11 @@ class WebOfKnowledgeSearcher:
             # formatted ISO-like with parts separated by dashes.
             if span.text[:10] == "Published:":
                 try:
-                    parsed['year'] = int(soup.findAll("span")[i+1].text.split()[-1].split()[-1])
+                    parsed['year'] = int(spans[i+1].text.split()[-1].split()[-1])
                     assert len(str( parsed['year'])) == 4
                 except (AssertionError, IndexError, ValueError):
                     try:
-                        parsed['year'] = int(soup.findAll("span")[i+1].text.split()[0].split('-')[0])
+                        parsed['year'] = int(spans[i+1].text.split()[0].split('-')[0])
                         assert len(str(parsed['year'])) == 4
                     except (AssertionError, IndexError, ValueError):
                         parsed = filter_out(parsed, 'year')
@@ -323,3 +779,69 @@ class WebOfKnowledgeSearcher:
             parsed = filter_out(parsed, "times_cited")
 
         return parsed
+
+
+class WebOfKnowledgeSearcherPool:
+    """Spread many queries over several independent WoK sessions that run in parallel.
+
+    Each searcher in the pool has its own session, cookies, session ID and query budget,
+    and any other keyword arguments (for example a shared cache) are passed to all of them.
+    A searcher is never used by more than one query at a time. With parse workers,
+    all searchers parse result pages in a shared pool of processes.
+    """
+
+    def __init__(self, nsessions=4, logfunc=None, parse_workers=0, **kwargs):
+
+        self.nsessions = nsessions
+
+        # All searchers can share one pool of processes for parsing pages, which is created
+        # before any threads are started, since the worker processes are forked.
+        self.parse_pool = None
+        if parse_workers:
+            self.parse_pool = multiprocessing.Pool(parse_workers)
+            kwargs['parse_pool'] = self.parse_pool
+
+        logfunc = logfunc or (lambda msg: sys.stdout.write("%s\n" %msg))
+        def create(i):
+            return WebOfKnowledgeSearcher(logfunc=lambda msg: logfunc("Session %i - %s" % (i, msg)), **kwargs)
+
+        # Sessions are created in parallel, too, since each one costs a request.
+        self.pool = ThreadPool(nsessions)
+        self.searchers = self.pool.map(create, range(nsessions))
+        self.idle = Queue.Queue()
+        for searcher in self.searchers:
+            self.idle.put(searcher)
+
+    post_request_count = property(lambda self: sum(s.post_request_count for s in self.searchers))
+    get_request_count = property(lambda self: sum(s.get_request_count for s in self.searchers))
+    session_count = property(lambda self: sum(s.session_count for s in self.searchers))
+
+    def _run(self, method, args):
+        """Call a method on the first idle searcher, blocking until one is available."""
+        searcher = self.idle.get()
+        try:
+            return getattr(searcher, method)(*args)
+        finally:
+            self.idle.put(searcher)
+
+    def map(self, method, arglist):
+        """Call a searcher method once for each tuple of arguments, in parallel.
+
+        The results are returned in the same order as the arguments.
+        """
+        return self.pool.map(lambda args: self._run(method, args), arglist)
+
+    def query_many(self, pairs):
+        """Perform a query for articles that contain two authors, for each pair of authors."""
+        return self.map('query_for_author_pair', pairs)
+
+    def query_many_titles(self, batches):
+        """Perform a query for titles, for each list of papers."""
+        return self.map('query_for_title', [(papers,) for papers in batches])
+
+    def close(self):
+        for searcher in self.searchers:
+            searcher.close()
+        self.pool.close()
+        if self.parse_pool:
+            self.parse_pool.close()
@@ -1,19 +1,102 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from suds.client import Client
-from suds.transport.http import HttpTransport
-import urllib2
+import collections
+import threading
+import time
 
-class HTTPSudsPreprocessor(urllib2.BaseHandler):
-    def __init__(self, SID):
-        self.SID = SID
+from StringIO import StringIO
 
-    def http_request(self, req):
-        req.add_header('cookie', 'SID="'+self.SID+'"')
-        return req
+from multiprocessing.pool import ThreadPool
 
-    https_request = http_request
+from suds.cache import ObjectCache
+from suds.client import Client, ServiceSelector
+from suds.options import Options
+from suds.transport import Reply, Transport, TransportError
+
+from wok_http import default_transport
+from wok_metrics import default_metrics
+
+class SessionTransport(Transport):
+    """Suds transport that sends everything through a session with pooled keep-alive connections.
+
+    The latency and size of each request are recorded in metrics (see wok_metrics.py).
+    """
+
+    def __init__(self, session, metrics=None):
+        Transport.__init__(self)
+        self.session = session
+        self.metrics = metrics or default_metrics
+
+    def open(self, request):
+        with self.metrics.timer('soap.wsdl.seconds'):
+            response = self.session.get(request.url, headers=request.headers)
+        if response.status_code >= 400:
+            raise TransportError(response.reason, response.status_code, StringIO(response.content))
+        return StringIO(response.content)
+
+    def send(self, request):
+        started = time.time()
+        response = self.session.post(request.url, data=request.message, headers=request.headers)
+        self.metrics.observe('soap.request.seconds', time.time() - started)
+        self.metrics.observe('soap.request.bytes_sent', len(request.message or ''))
+        self.metrics.observe('soap.request.bytes', len(response.content))
+        if response.status_code in (202, 204):
+            return None
+        if response.status_code >= 400:
+            self.metrics.count('soap.request.errors')
+            raise TransportError(response.reason, response.status_code, StringIO(response.content))
+        return Reply(response.status_code, response.headers, response.content)
+
+
+def clone_client(client, transport):
+    """Return a clone of a suds client, which shares its parsed WSDL but uses another transport.
+
+    This does the same as Client.clone, which does not work in suds 0.4 for clients
+    with a custom transport, because it copies the options with the transport.
+    """
+    clone = Client.__new__(Client)
+    clone.options = Options()
+    clone.set_options(cache=client.options.cache, cachingpolicy=client.options.cachingpolicy, transport=transport)
+    clone.wsdl = client.wsdl
+    clone.factory = client.factory
+    clone.service = ServiceSelector(clone, client.wsdl.services)
+    clone.sd = client.sd
+    clone.messages = dict(tx=None, rx=None)
+    return clone
+
+
+class SessionHolder:
+    """Thread-safe holder of one authenticated WoK session ID, shared between clients.
+
+    The first client that needs a session authenticates, and all others reuse its SID
+    until it is older than lifetime (in seconds) or is invalidated, which is much faster
+    than authenticating for each client. WoK sessions time out after some idle time,
+    so the lifetime should be well below that.
+    """
+
+    def __init__(self, lifetime=3000):
+        self.lifetime = lifetime
+        self.lock = threading.Lock()
+        self.SID = None
+        self.expires = 0
+
+    def get(self, authenticate):
+        """Return the current SID, calling authenticate() for a new one if there is none or it expired."""
+        with self.lock:
+            if self.SID is None or time.time() > self.expires:
+                self.SID = authenticate()
+                self.expires = time.time() + self.lifetime
+            return self.SID
+
+    def invalidate(self, SID=None):
+        """Forget the current SID (only if it is still the given one), so the next client authenticates."""
+        with self.lock:
+            if SID is None or SID == self.SID:
+                self.SID = None
+
+
+default_sessions = SessionHolder()
 
 
 class WokmwsSoapClient():
@@ -21,42 +104,109 @@ class WokmwsSoapClient():
     main steps you have to do:
         soap = WokmwsSoapClient()
         results = soap.search(...)
+    or to get all records found (see iter_search):
+        records = soap.search_all(...)
+
+    The WSDLs are parsed only once per thread (and kept on disk in wsdl_cache for
+    wsdl_cache_days, so later threads and processes do not even fetch them), and one session is
+    shared by all clients (see SessionHolder), so creating more clients is cheap.
+    Call close() to end the shared session when it is not needed anymore.
     """
-    def __init__(self):
-        self.url = self.client = {}
+
+    url = {
+        'auth' : 'http://search.isiknowledge.com/esti/wokmws/ws/WOKMWSAuthenticate?wsdl',
+        'search' : 'http://search.isiknowledge.com/esti/wokmws/ws/WokSearchLite?wsdl',
+    }
+
+    # The location of the on-disk cache of parsed WSDLs (None is the default temporary directory
+    # used by suds), and how long they are kept there.
+    wsdl_cache = None
+    wsdl_cache_days = 7
+
+    # The WoK API returns at most 100 records per request, and iter_search retrieves
+    # up to max_in_flight such pages at the same time.
+    max_page_size = 100
+    max_in_flight = 4
+
+    # Parsed clients for each WSDL URL, which new clients are cloned from. Clients that share
+    # a parsed WSDL cannot be used at the same time, so they are kept separately for each thread.
+    _clients = threading.local()
+
+    # Pages are retrieved in a pool of retrieve_threads threads that is shared by all clients
+    # and lives as long as the process, so that each thread parses the WSDL only once and keeps
+    # its client for retrieving pages (in _retrievers) for all later searches.
+    retrieve_threads = 8
+    _retrieve_pool = None
+    _retrieve_lock = threading.Lock()
+    _retrievers = threading.local()
+
+    def __init__(self, transport=None, sessions=None, metrics=None):
+        self.client = {}
         self.SID = ''
+        self.transport = transport or default_transport
+        self.sessions = sessions or default_sessions
 
-        self.url['auth'] = 'http://search.isiknowledge.com/esti/wokmws/ws/WOKMWSAuthenticate?wsdl'
-        self.url['search'] = 'http://search.isiknowledge.com/esti/wokmws/ws/WokSearchLite?wsdl'
+        # Requests and calls are timed here (see wok_metrics.py), with names starting with 'soap.'.
+        self.metrics = metrics or default_metrics
 
         self.prepare()
 
-    def __del__(self):
-        self.close()
-
     def prepare(self):
         """does all the initialization we need for a request"""
         self.initAuthClient()
         self.authenticate()
         self.initSearchClient()
 
+    def cloneClient(self, url, session):
+        """Return a client for a WSDL URL that sends requests through a session.
+
+        The WSDL is loaded and parsed only the first time in each thread, after which the
+        client is cloned (see clone_client), which shares the parsed WSDL but nothing else.
+        With cachingpolicy 1 suds keeps the whole parsed WSDL in the on-disk cache, not just
+        the documents.
+        """
+        clients = self._clients.__dict__.setdefault('clients', {})
+        if url not in clients:
+            clients[url] = self.loadClient(url, session)
+        return clone_client(clients[url], SessionTransport(session, self.metrics))
+
+    def loadClient(self, url, session):
+        """Return a client with its own copy of the parsed WSDL, from the on-disk cache if it is there."""
+        cache = ObjectCache(self.wsdl_cache, days=self.wsdl_cache_days)
+        with self.metrics.timer('soap.load.seconds'):
+            return Client(url, transport=SessionTransport(session, self.metrics), cache=cache, cachingpolicy=1)
+
     def initAuthClient(self):
-        self.client['auth'] = Client(self.url['auth'])
+        self.client['auth'] = self.cloneClient(self.url['auth'], self.transport.session())
 
     def initSearchClient(self):
-        http = HttpTransport()
-        opener = urllib2.build_opener(HTTPSudsPreprocessor(self.SID))
-        http.urlopener = opener
-        self.client['search'] = Client(self.url['search'], transport = http)
+        session = self.transport.session(headers={'Cookie' : 'SID="'+self.SID+'"'})
+        self.client['search'] = self.cloneClient(self.url['search'], session)
+
+    def newSession(self):
+        """Authenticate for a new SID, which is called by the session holder only when needed."""
+        self.metrics.count('soap.sessions')
+        with self.metrics.timer('soap.authenticate.seconds'):
+            return self.client['auth'].service.authenticate()
 
     def authenticate(self):
-        self.SID = self.client['auth'].service.authenticate()
+        self.SID = self.sessions.get(self.newSession)
+
+    def refresh(self):
+        """Switch to the current shared session, if it has changed or expired since the last request."""
+        SID = self.sessions.get(self.newSession)
+        if SID != self.SID:
+            self.SID = SID
+            self.client['search'].options.transport.session.headers['Cookie'] = 'SID="'+self.SID+'"'
 
     def close(self):
+        """Close the shared session, so that all clients will use a new one."""
+        self.sessions.invalidate(self.SID)
+        self.client['auth'].options.transport.session.headers['Cookie'] = 'SID="'+self.SID+'"'
         self.client['auth'].service.closeSession()
 
-    def search(self, query):
-        qparams = {
+    def query_parameters(self, query):
+        return {
             'databaseID' : 'WOS',
             'userQuery' : query,
             'queryLanguage' : 'en',
@@ -69,13 +219,93 @@ class WokmwsSoapClient():
             }]
         }
 
-        rparams = {
-            'count' : 5, # 1-100
-            'firstRecord' : 1,
+    def retrieve_parameters(self, first, count):
+        return {
+            'count' : count, # 1-100
+            'firstRecord' : first,
             'fields' : [{
                 'name' : 'Relevance',
                 'sort' : 'D',
             }],
         }
 
-        return self.client['search'].service.search(qparams, rparams)
+    def search(self, query, count=5, first=1):
+        self.refresh()
+        with self.metrics.timer('soap.search.seconds'):
+            results = self.client['search'].service.search(self.query_parameters(query), self.retrieve_parameters(first, count))
+        self.metrics.count('soap.records', len(getattr(results, 'records', [])))
+        return results
+
+    def retrieve(self, queryId, first, count, client=None):
+        """Retrieve more records of an earlier search, identified by the queryId it returned."""
+        client = client or self.client['search']
+        with self.metrics.timer('soap.retrieve.seconds'):
+            results = client.service.retrieve(queryId, self.retrieve_parameters(first, count))
+        self.metrics.count('soap.records', len(getattr(results, 'records', [])))
+        return results
+
+    @classmethod
+    def retrievePool(cls):
+        """Return the pool of threads for retrieving pages, creating it the first time."""
+        with cls._retrieve_lock:
+            if cls._retrieve_pool is None:
+                cls._retrieve_pool = ThreadPool(cls.retrieve_threads)
+            return cls._retrieve_pool
+
+    def retrieveClient(self, SID):
+        """Return the client of the current thread for retrieving pages, sending the given SID.
+
+        There is one client in each thread for each URL, transport and metrics, which is created
+        only the first time (see cloneClient) and used by all later searches.
+        """
+        clients = self._retrievers.__dict__.setdefault('clients', {})
+        key = (self.url['search'], self.transport, self.metrics)
+        if key not in clients:
+            clients[key] = self.cloneClient(self.url['search'], self.transport.session())
+        clients[key].options.transport.session.headers['Cookie'] = 'SID="'+SID+'"'
+        return clients[key]
+
+    def iter_search(self, query, page_size=None, max_in_flight=None):
+        """Generate all records found for a query, in order.
+
+        The first page comes from the search itself, which also tells how many records there
+        are, and the remaining pages are retrieved by the query ID in the pool of threads shared
+        by all clients (see retrievePool). Only max_in_flight pages are requested ahead of the
+        records that have been consumed, so the memory used does not depend on the number of
+        records found.
+        """
+
+        page_size = page_size or self.max_page_size
+        max_in_flight = max_in_flight or self.max_in_flight
+
+        results = self.search(query, count=page_size)
+        for record in getattr(results, 'records', []):
+            yield record
+
+        total = results.recordsFound
+        starts = range(1 + page_size, total + 1, page_size)
+        if not starts:
+            return
+
+        SID = self.SID
+        def retrieve_page(first):
+            client = self.retrieveClient(SID)
+            return self.retrieve(results.queryId, first, min(page_size, total - first + 1), client=client)
+
+        # The pool is never closed, and when the generator is not consumed to the end,
+        # the pages in flight are still retrieved but their records are dropped.
+        pool = self.retrievePool()
+        pending = collections.deque()
+        for first in starts:
+            pending.append(pool.apply_async(retrieve_page, (first,)))
+            if len(pending) < max_in_flight:
+                continue
+            for record in getattr(pending.popleft().get(), 'records', []):
+                yield record
+        while pending:
+            for record in getattr(pending.popleft().get(), 'records', []):
+                yield record
+
+    def search_all(self, query, **kwargs):
+        """Return a list of all records found for a query (see iter_search)."""
+        return list(self.iter_search(query, **kwargs))
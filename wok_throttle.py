@@ -0,0 +1,140 @@
+import random
+import threading
+import time
+
+
+class RandomJitterThrottle:
+    """Pace queries blindly with random delays, regardless of how the server responds.
+
+    This is how WebOfKnowledgeSearcher always behaved: a short random delay before
+    about a quarter of all queries, and a longer one before each session reset.
+    """
+
+    def __init__(self, probability=0.25, delay=0.5, reset_delay=0.5, reset_jitter=5.0):
+        self.probability = probability
+        self.delay = delay
+        self.reset_delay = reset_delay
+        self.reset_jitter = reset_jitter
+        self.slept = 0.0
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+        self.slept += seconds
+
+    def wait(self):
+        """Called before each query."""
+        if random.random() < self.probability:
+            self._sleep(self.delay*random.random())
+
+    def wait_reset(self):
+        """Called before creating a new session."""
+        self._sleep(self.reset_delay + self.reset_jitter*random.random())
+
+    def success(self):
+        """Called after a healthy response from the server."""
+        pass
+
+    def failure(self):
+        """Called after a failed request or a response that could not be parsed."""
+        pass
+
+
+class AIMDThrottle(RandomJitterThrottle):
+    """Token bucket with a rate that adapts to how the server responds.
+
+    The rate (in queries per second) increases additively after each healthy response
+    and decreases multiplicatively after each failure, within the given bounds, so queries
+    run at about the fastest pace the server tolerates. Tokens accumulate up to the burst
+    size while idle. This is thread-safe, so one throttle can pace several searchers.
+    """
+
+    def __init__(self, rate=1.0, min_rate=0.05, max_rate=10.0, increase=0.1, decrease=0.5, burst=1.0):
+
+        RandomJitterThrottle.__init__(self)
+
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+
+        # Take a token even if there are none left, so that concurrent callers queue up
+        # behind each other, each sleeping until its own token would have accumulated.
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if delay > 0:
+            self._sleep(delay)
+
+    def wait_reset(self):
+        self.wait()
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def failure(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+
+
+class ConcurrencyLimiter:
+    """Limit the number of requests in flight, adapting the limit to how the server responds.
+
+    The limit grows by about one after each full window of successful requests, and it is
+    halved after a failure, but only once for all requests that were already in flight
+    at that point. When the latency rises well above the lowest one seen so far, the limit
+    shrinks slowly, since the server is probably queueing requests by then. Use acquire
+    before each request and pass the value it returns to release afterwards.
+    """
+
+    def __init__(self, limit=5, min_limit=1, max_limit=50, decrease=0.5, latency_factor=2.0):
+
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+
+        self.inflight = 0
+        self.min_latency = None
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until there is room for another request, and return its start time."""
+        with self.condition:
+            while self.inflight >= int(self.limit):
+                self.condition.wait()
+            self.inflight += 1
+        return time.time()
+
+    def release(self, started, failed=False):
+        """Register a finished request, given its start time and whether it failed."""
+
+        now = time.time()
+        latency = now - started
+        with self.condition:
+            self.inflight -= 1
+            if failed:
+                if started > self.last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.last_decrease = now
+            else:
+                self.min_latency = min(self.min_latency or latency, latency)
+                if latency > self.latency_factor * self.min_latency:
+                    self.limit = max(self.min_limit, self.limit - 1.0 / self.limit)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()